@@ -0,0 +1,93 @@
+"""Сравнение пропускной способности: синхронные вызовы БД в обработчиках и database_async.
+
+Запуск из корня проекта (нужен DATABASE_URL):
+
+    python -m benchmarks.event_loop --updates 500 --concurrency 50
+
+Каждое "обновление" делает те же запросы, что и show_progress. В режиме sync
+запросы блокируют event loop, в режиме async выполняются в пуле потоков.
+Дополнительно измеряется задержка event loop (насколько опаздывает таймер 10 мс),
+то есть насколько запрос одного пользователя тормозит всех остальных и job queue.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import database as db
+import database_async as adb
+
+
+async def sync_update(user_id):
+    db.get_user_stats(user_id)
+    db.get_user_rank(user_id)
+    db.get_today_pullups(user_id)
+
+
+async def async_update(user_id):
+    await adb.get_user_stats(user_id)
+    await adb.get_user_rank(user_id)
+    await adb.get_today_pullups(user_id)
+
+
+async def measure_loop_lag(stop, samples, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run_mode(handler, user_ids, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lag_samples))
+
+    async def one_update():
+        async with semaphore:
+            await handler(random.choice(user_ids))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_update() for _ in range(updates)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await lag_task
+    lag_samples.sort()
+    return {
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1),
+        'max_loop_lag_ms': round(lag_samples[-1] * 1000, 1) if lag_samples else None,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    user_ids = db.get_all_users() or [0]
+    results = {
+        'sync': await run_mode(sync_update, user_ids, args.updates, args.concurrency),
+        'async': await run_mode(async_update, user_ids, args.updates, args.concurrency),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for mode, result in results.items():
+            print(
+                f"{mode:>5}: {result['updates_per_second']} обновлений/с, "
+                f"{result['seconds']} с, макс. задержка event loop {result['max_loop_lag_ms']} мс"
+            )
+
+    adb.shutdown()
+    db.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
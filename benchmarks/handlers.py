@@ -0,0 +1,388 @@
+"""Нагрузочный замер обработчиков бота: задержка по обработчикам и запросы к БД на обновление.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.handlers --users 200 --updates-per-user 20
+    python -m benchmarks.handlers --store memory --json > before.json
+
+Синтетические Update проходят через bot.handle_message. Ответы уходят в
+заглушку вместо Telegram (--api-latency задает ее задержку). Каждый
+виртуальный пользователь отправляет свои сообщения по очереди, пользователи
+работают одновременно. Смесь сообщений задается --mix: числа (add), кнопки
+"🏆 Лидерборд" (leaderboard), "👤 Мой прогресс" (progress) и "↩️ Undo" (undo).
+
+Хранилище:
+    postgres - настоящая БД по DATABASE_URL (используйте отдельную тестовую
+               базу: пользователи бенчмарка остаются в ней);
+    memory   - итоги в памяти вместо database_async, чтобы отделить накладные
+               расходы бота от БД.
+
+Запросы к БД на обновление считаются отдельным последовательным прогоном
+каждого обработчика, а под нагрузкой - в среднем по всем обновлениям.
+С --json результат выводится в машиночитаемом виде вместе с коммитом,
+чтобы сравнивать замеры между коммитами.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import threading
+import time
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+from psycopg2 import extensions
+from telegram import Chat, Message, Update, User
+
+import bot
+import config
+import database as db
+import database_async as adb
+import ranking
+from leaderboard_cache import LeaderboardCache
+
+# Тексты сообщений для каждого вида обновлений
+MESSAGES = {
+    'add': None,  # случайное число
+    'leaderboard': "🏆 Лидерборд",
+    'progress': "👤 Мой прогресс",
+    'undo': "↩️ Undo",
+}
+DEFAULT_MIX = 'add=60,leaderboard=15,progress=15,undo=10'
+USER_ID_OFFSET = 9_000_000_000
+
+
+class QueryCounter:
+    """Потокобезопасный счетчик запросов к хранилищу"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def add(self):
+        with self._lock:
+            self.value += 1
+
+
+queries = QueryCounter()
+_counting_cursors = {}
+
+
+def _counting_cursor(base):
+    """Подкласс курсора base, считающий каждый execute"""
+    cls = _counting_cursors.get(base)
+    if cls is None:
+        def execute(self, query, vars=None):
+            queries.add()
+            return base.execute(self, query, vars)
+        cls = _counting_cursors[base] = type(f"Counting{base.__name__}", (base,), {'execute': execute})
+    return cls
+
+
+class CountingConnection(extensions.connection):
+    """Соединение, все курсоры которого считают запросы"""
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        base = cursor_factory or self.cursor_factory or extensions.cursor
+        return super().cursor(*args, cursor_factory=_counting_cursor(base), **kwargs)
+
+
+class StubBot:
+    """Заглушка Telegram: принимает ответы с заданной задержкой"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class MemoryStore:
+    """Итоги пользователей в памяти с тем же интерфейсом, что и database_async"""
+
+    def __init__(self):
+        self.users = {}    # user_id -> профиль
+        self.entries = {}  # user_id -> [(дата, количество)]
+        self.listeners = []
+
+    def _notify(self, user_id, delta):
+        for callback in self.listeners:
+            callback(user_id, delta)
+
+    def _totals(self, user_id):
+        entries = self.entries.get(user_id, [])
+        today = date.today()
+        total = sum(count for _, count in entries)
+        today_total = sum(count for day, count in entries if day == today)
+        return total, today_total, len({day for day, _ in entries}), len(entries)
+
+    async def add_pullups_and_summarize(self, user_id, count, username=None, first_name=None,
+                                        last_name=None, pullup_date=None):
+        queries.add()
+        counts = [count] if isinstance(count, int) else list(count)
+        self.users[user_id] = {'username': username, 'first_name': first_name}
+        day = pullup_date or date.today()
+        self.entries.setdefault(user_id, []).extend((day, c) for c in counts)
+        self._notify(user_id, sum(counts))
+        total, today, _, _ = self._totals(user_id)
+        return {'today': today, 'total': total}
+
+    async def undo_last_pullups(self, user_id, steps=1):
+        queries.add()
+        entries = self.entries.get(user_id, [])
+        removed = [entries.pop() for _ in range(min(steps, len(entries)))]
+        removed_count = sum(count for _, count in removed)
+        if removed:
+            self._notify(user_id, -removed_count)
+        total, today, _, _ = self._totals(user_id)
+        return {'removed_count': removed_count, 'removed_entries': len(removed),
+                'today': today, 'total': total}
+
+    async def get_user_stats(self, user_id):
+        queries.add()
+        total, _, days_count, records_count = self._totals(user_id)
+        days_passed = max(1, (date.today() - config.CHALLENGE_START_DATE).days + 1)
+        # Серии по дням подряд, как recompute_user_streaks в БД
+        days = sorted({day for day, _ in self.entries.get(user_id, [])})
+        current_streak = longest_streak = 0
+        for previous, day in zip([None] + days, days):
+            current_streak = current_streak + 1 if previous and (day - previous).days == 1 else 1
+            longest_streak = max(longest_streak, current_streak)
+        if not days or (date.today() - days[-1]).days > 1:
+            current_streak = 0
+        return {
+            'total': total,
+            'days_count': days_count,
+            'avg_per_day': round(total / days_passed, 2),
+            'progress_percent': round(total / config.CHALLENGE_TARGET * 100, 2),
+            'records_count': records_count,
+            'current_streak': current_streak,
+            'longest_streak': longest_streak,
+        }
+
+    async def get_today_pullups(self, user_id):
+        queries.add()
+        return self._totals(user_id)[1]
+
+    async def get_user_total(self, user_id):
+        queries.add()
+        return self._totals(user_id)[0]
+
+    async def get_user_rank(self, user_id):
+        queries.add()
+        return ranking.index.rank(user_id)
+
+    async def get_leaderboard(self, limit=20):
+        queries.add()
+        return [
+            {'user_id': user_id, 'username': self.users[user_id]['username'],
+             'first_name': self.users[user_id]['first_name'], 'total': total}
+            for user_id, total in ranking.index.top(limit)
+        ]
+
+    def get_all_totals(self):
+        return [(user_id, self._totals(user_id)[0]) for user_id in self.users]
+
+
+def setup_postgres():
+    """Пул с подсчетом запросов, рейтинг и кэш лидерборда, как в bot.main()"""
+    db.close_pool()
+    db._pool = db.ConnectionPool(
+        config.DATABASE_URL,
+        min_size=config.DB_POOL_MIN_SIZE,
+        max_size=config.DB_POOL_MAX_SIZE,
+        timeout=config.DB_POOL_TIMEOUT,
+        healthcheck_interval=config.DB_POOL_HEALTHCHECK_INTERVAL,
+        connection_factory=CountingConnection
+    )
+    db.init_database()
+    ranking.load()
+    db.add_write_listener(bot.leaderboard_cache.on_write)
+
+
+def setup_memory():
+    """Подменяет database_async хранилищем в памяти"""
+    store = MemoryStore()
+    for name in ('add_pullups_and_summarize', 'undo_last_pullups', 'get_user_stats',
+                 'get_today_pullups', 'get_user_total', 'get_user_rank', 'get_leaderboard'):
+        setattr(adb, name, getattr(store, name))
+    bot.leaderboard_cache = LeaderboardCache(
+        fetch=store.get_leaderboard,
+        render=bot.format_leaderboard,
+        limit=bot.leaderboard_cache.limit,
+        ttl=bot.leaderboard_cache.ttl,
+        total_lookup=ranking.index.get_total
+    )
+    ranking.index.load([])
+    store.listeners = [ranking.index.apply, bot.leaderboard_cache.on_write]
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGES:
+            raise argparse.ArgumentTypeError(f"неизвестный вид сообщения: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def make_update(update_id, user_id, text, stub):
+    user = User(user_id, f"Bench {user_id}", False, username=f"bench{user_id}")
+    chat = Chat(user_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=user, text=text)
+    message.set_bot(stub)
+    return Update(update_id, message=message)
+
+
+def message_text(kind, rng):
+    return str(rng.randint(5, 30)) if kind == 'add' else MESSAGES[kind]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class Runner:
+    def __init__(self, stub):
+        self.stub = stub
+        self.context = SimpleNamespace(args=[], bot=stub)
+        self._update_id = 0
+
+    async def send(self, user_id, text):
+        """Прогоняет одно сообщение через handle_message; возвращает время в секундах"""
+        self._update_id += 1
+        update = make_update(self._update_id, user_id, text, self.stub)
+        started = time.perf_counter()
+        await bot.handle_message(update, self.context)
+        return time.perf_counter() - started
+
+
+async def probe_queries(runner, user_ids, rng, samples):
+    """Запросы к хранилищу на одно обновление каждого вида, последовательно"""
+    result = {}
+    for kind in MESSAGES:
+        before = queries.value
+        for i in range(samples):
+            await runner.send(user_ids[i % len(user_ids)], message_text(kind, rng))
+        result[kind] = round((queries.value - before) / samples, 2)
+    return result
+
+
+async def run_load(runner, user_ids, updates_per_user, mix, rng):
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    latencies = {kind: [] for kind in kinds}
+
+    async def simulate_user(user_id):
+        for kind in rng.choices(kinds, weights, k=updates_per_user):
+            latencies[kind].append(await runner.send(user_id, message_text(kind, rng)))
+
+    before = queries.value
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    total_updates = sum(len(values) for values in latencies.values())
+
+    handlers = {}
+    for kind, values in latencies.items():
+        values.sort()
+        handlers[kind] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2) if values else 0.0,
+        }
+    return {
+        'updates': total_updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total_updates / elapsed, 1) if elapsed > 0 else 0.0,
+        'queries_per_update': round((queries.value - before) / total_updates, 2) if total_updates else 0.0,
+        'handlers': handlers,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--updates-per-user', type=int, default=20)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'доли видов сообщений (по умолчанию: {DEFAULT_MIX})')
+    parser.add_argument('--store', choices=('postgres', 'memory'), default='postgres')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='задержка заглушки Telegram на ответ, мс')
+    parser.add_argument('--probe-samples', type=int, default=20,
+                        help='обновлений каждого вида для подсчета запросов')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.store == 'postgres':
+        setup_postgres()
+    else:
+        setup_memory()
+    # Буфер записей отвечал бы после окна, а замеряется сам обработчик
+    bot.write_coalescer.window = 0
+
+    stub = StubBot(args.api_latency / 1000)
+    runner = Runner(stub)
+    user_ids = [USER_ID_OFFSET + i for i in range(args.users)]
+    try:
+        # Первое число регистрирует пользователя
+        await asyncio.gather(*(runner.send(user_id, "10") for user_id in user_ids))
+        probe = await probe_queries(runner, user_ids, rng, args.probe_samples)
+        load = await run_load(runner, user_ids, args.updates_per_user, args.mix, rng)
+    finally:
+        if args.store == 'postgres':
+            adb.shutdown()
+            db.close_pool()
+
+    results = {
+        'commit': git_commit(),
+        'store': args.store,
+        'users': args.users,
+        'updates_per_user': args.updates_per_user,
+        'mix': args.mix,
+        'api_latency_ms': args.api_latency,
+        'queries_per_update_by_handler': probe,
+        **load,
+        'leaderboard_cache': bot.leaderboard_cache.stats(),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return
+
+    print(
+        f"{results['updates']} обновлений за {results['seconds']} с: "
+        f"{results['updates_per_second']} обновлений/с, "
+        f"{results['queries_per_update']} запросов к БД на обновление"
+    )
+    print(f"{'обработчик':>12} {'кол-во':>7} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'запросов':>9}")
+    for kind, stats in results['handlers'].items():
+        print(
+            f"{kind:>12} {stats['count']:>7} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+            f"{stats['p99_ms']:>8} {probe[kind]:>9}"
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,17 +1,35 @@
 import logging
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    KeyboardButton,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
-from telegram.error import TimedOut, NetworkError
+from telegram.error import TimedOut, NetworkError, BadRequest
 from datetime import date, datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import database as db
+import database_async as adb
 import config
+import metrics
 import reminders
+import ranking
+import compaction
+import change_listener
+import group_chats
+from leaderboard_cache import LeaderboardCache
+from write_coalescer import WriteCoalescer
+from update_processor import PerUserUpdateProcessor
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,11 +37,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Сколько записей можно отменить одной командой /undo N
+MAX_UNDO_STEPS = 20
+
+# Больше за один подход не бывает: такие числа - опечатки, в сумму они не попадают
+MAX_PULLUPS_PER_ENTRY = 10000
+
+# Строк на странице лидерборда и соседей выше и ниже в режиме "Я в рейтинге"
+LEADERBOARD_PAGE_SIZE = 20
+LEADERBOARD_AROUND = 5
 
+
+@metrics.track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
-    db.add_user(
+    await adb.add_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -67,11 +96,11 @@ def get_main_keyboard():
 
 async def handle_add_pullups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик добавления подтягиваний"""
-    user_id = update.effective_user.id
+    user = update.effective_user
     text = update.message.text.strip()
     
     # Если это число, добавляем подтягивания
-    if text.isdigit():
+    if text.isdecimal():
         count = int(text)
         
         if count <= 0:
@@ -81,28 +110,15 @@ async def handle_add_pullups(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         
-        # Добавляем подтягивания
-        success = db.add_pullups(user_id, count)
-        
-        if success:
-            total = db.get_user_total(user_id)
-            today = db.get_today_pullups(user_id)
-            
-            response = (
-                f"✅ Добавлено {count} подтягиваний.\n\n"
-                f"📅 Сегодня: {today}\n"
-                f"📊 Всего: {total:,}"
-            )
-            
-            await update.message.reply_text(
-                response,
-                reply_markup=get_main_keyboard()
-            )
-        else:
+        if count > MAX_PULLUPS_PER_ENTRY:
             await update.message.reply_text(
-                "❌ Ошибка при добавлении подтягиваний. Попробуй еще раз.",
+                f"❌ Не больше {MAX_PULLUPS_PER_ENTRY:,} за одну запись. Проверь число и отправь еще раз.",
                 reply_markup=get_main_keyboard()
             )
+            return
+        
+        # Запись попадает в буфер пользователя, ответ придет после сброса в БД
+        await write_coalescer.add(user, count, update.message)
     else:
         # Если не число, просим ввести число
         await update.message.reply_text(
@@ -111,42 +127,101 @@ async def handle_add_pullups(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
 
+async def write_pullups(user, counts, pullup_date):
+    """Записывает подтягивания из буфера и возвращает новые итоги"""
+    return await adb.add_pullups_and_summarize(
+        user.id,
+        counts,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        pullup_date=pullup_date
+    )
+
+
+async def reply_pullups_added(message, counts, summary):
+    """Одно подтверждение на все записи из буфера"""
+    if not summary:
+        await message.reply_text(
+            "❌ Ошибка при добавлении подтягиваний. Попробуй еще раз.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    if len(counts) == 1:
+        added = f"✅ Добавлено {counts[0]} подтягиваний."
+    else:
+        added = f"✅ Добавлено {' + '.join(map(str, counts))} = {sum(counts)} подтягиваний."
+    
+    response = (
+        f"{added}\n\n"
+        f"📅 Сегодня: {summary['today']}\n"
+        f"📊 Всего: {summary['total']:,}"
+    )
+    
+    await message.reply_text(
+        response,
+        reply_markup=get_main_keyboard()
+    )
+
+
+# Числа, присланные подряд за WRITE_COALESCE_WINDOW секунд, записываются одной вставкой
+write_coalescer = WriteCoalescer(
+    write=write_pullups,
+    reply=reply_pullups_added,
+    window=config.WRITE_COALESCE_WINDOW,
+    max_entries=config.WRITE_COALESCE_MAX_ENTRIES
+)
+
+
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
     text = update.message.text
     user_id = update.effective_user.id
     
+    # Кнопки показывают итоги, поэтому сначала записываем то, что ждет в буфере
+    await write_coalescer.flush(user_id)
+    
+    # Время и ошибки обновления считаются под именем выбранного действия
     if text == "➕ Добавить":
+        metrics.label_handler('add_prompt')
         await update.message.reply_text(
             "Введи количество подтягиваний (просто число, например: 15, 50, 100)",
             reply_markup=get_main_keyboard()
         )
         
     elif text == "👤 Мой прогресс":
+        metrics.label_handler('show_progress')
         await show_progress(update, user_id)
         
     elif text == "🏆 Лидерборд":
+        metrics.label_handler('show_leaderboard')
         await show_leaderboard(update, user_id)
         
     elif text == "📅 Сегодня":
+        metrics.label_handler('show_today_stats')
         await show_today_stats(update, user_id)
         
     elif text == "📌 Правила":
+        metrics.label_handler('show_rules')
         await show_rules(update)
         
     elif text == "↩️ Undo":
+        metrics.label_handler('undo_last')
         await undo_last(update, user_id)
         
     else:
         # Если это не кнопка, пытаемся добавить как число
+        metrics.label_handler('handle_add_pullups')
         await handle_add_pullups(update, context)
 
 
 async def show_progress(update: Update, user_id: int):
     """Показывает прогресс пользователя"""
-    stats = db.get_user_stats(user_id)
+    stats = await adb.get_user_stats(user_id)
     total = stats['total']
-    rank = db.get_user_rank(user_id)
+    rank = await ranking.get_user_rank(user_id)
+    today_count = await adb.get_today_pullups(user_id)
     today = date.today()
     days_remaining = (config.CHALLENGE_END_DATE - today).days
     
@@ -154,8 +229,8 @@ async def show_progress(update: Update, user_id: int):
     remaining = config.CHALLENGE_TARGET - total
     needed_per_day = remaining / days_remaining if days_remaining > 0 else 0
     
-    # Проверяем отставание от плана (50 в день)
-    target_per_day = 50
+    # Проверяем отставание от плана (DAILY_PLAN в день)
+    target_per_day = config.DAILY_PLAN
     days_passed = max(1, (today - config.CHALLENGE_START_DATE).days + 1)
     expected_total = target_per_day * days_passed
     is_behind = total < expected_total
@@ -163,13 +238,14 @@ async def show_progress(update: Update, user_id: int):
     progress_text = (
         f"👤 Ваш прогресс:\n\n"
         f"📊 Всего: {total:,} подтягиваний\n"
-        f"📅 Сегодня: {db.get_today_pullups(user_id)}\n"
+        f"📅 Сегодня: {today_count}\n"
         f"📈 Среднее в день: {stats['avg_per_day']}\n"
+        f"🔥 Серия: {stats['current_streak']} дн. подряд (лучшая: {stats['longest_streak']})\n"
         f"🎯 Осталось до цели: {remaining:,}\n"
     )
     
     if is_behind:
-        progress_text += f"⚠️ Вы отстаете от плана (50/день)\n"
+        progress_text += f"⚠️ Вы отстаете от плана ({target_per_day}/день)\n"
     
     progress_text += f"🏠 Нужно в день до конца года: {needed_per_day:.0f}"
     
@@ -182,9 +258,61 @@ async def show_progress(update: Update, user_id: int):
     )
 
 
+def format_leaderboard(leaderboard, start=1, highlight=None, title=None):
+    """Формирует текст страницы лидерборда, start - место первой строки"""
+    if title:
+        leaderboard_text = f"🏆 {title}:\n\n"
+    elif start == 1:
+        leaderboard_text = f"🏆 ТОП-{LEADERBOARD_PAGE_SIZE} ЛИДЕРОВ:\n\n"
+    else:
+        leaderboard_text = f"🏆 РЕЙТИНГ, места {start}-{start + len(leaderboard) - 1}:\n\n"
+    
+    for idx, user in enumerate(leaderboard, start):
+        name = user['first_name'] or user['username'] or f"User {user['user_id']}"
+        total = user['total']
+        medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else f"{idx}."
+        mark = " 👈" if user['user_id'] == highlight else ""
+        leaderboard_text += f"{medal} {name}: {total:,}{mark}\n"
+    
+    return leaderboard_text
+
+
+def get_leaderboard_keyboard(leaderboard, start, has_next):
+    """Кнопки листания лидерборда; в callback_data - ключ (total, user_id) крайней строки"""
+    buttons = []
+    if start > 1:
+        first = leaderboard[0]
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"lb:prev:{first['total']}:{first['user_id']}"))
+    buttons.append(InlineKeyboardButton("🏆 Топ", callback_data="lb:top"))
+    buttons.append(InlineKeyboardButton("📍 Я", callback_data="lb:me"))
+    if has_next:
+        last = leaderboard[-1]
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"lb:next:{last['total']}:{last['user_id']}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+# Первая страница с готовым текстом: серия нажатий на "Лидерборд" стоит один запрос к БД
+leaderboard_cache = LeaderboardCache(
+    fetch=adb.get_leaderboard,
+    render=format_leaderboard,
+    limit=LEADERBOARD_PAGE_SIZE,
+    ttl=config.LEADERBOARD_CACHE_TTL,
+    total_lookup=ranking.index.get_total
+)
+
+
+async def add_user_position(leaderboard_text, user_id):
+    """Дописывает к тексту лидерборда позицию пользователя"""
+    user_rank = await ranking.get_user_rank(user_id)
+    if user_rank:
+        user_total = await ranking.get_user_total(user_id)
+        leaderboard_text += f"\n📍 Ваша позиция: #{user_rank} ({user_total:,} подтягиваний)"
+    return leaderboard_text
+
+
 async def show_leaderboard(update: Update, user_id: int):
-    """Показывает лидерборд"""
-    leaderboard = db.get_leaderboard(20)
+    """Показывает первую страницу лидерборда с кнопками листания"""
+    leaderboard, leaderboard_text = await leaderboard_cache.get()
     
     if not leaderboard:
         await update.message.reply_text(
@@ -193,29 +321,126 @@ async def show_leaderboard(update: Update, user_id: int):
         )
         return
     
-    leaderboard_text = "🏆 ТОП-20 ЛИДЕРОВ:\n\n"
+    await update.message.reply_text(
+        await add_user_position(leaderboard_text, user_id),
+        reply_markup=get_leaderboard_keyboard(
+            leaderboard, 1, len(leaderboard) == LEADERBOARD_PAGE_SIZE
+        )
+    )
+
+
+@metrics.track_handler
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /top: в группе - рейтинг участников чата, в личном чате - общий"""
+    chat = update.effective_chat
+    user_id = update.effective_user.id
+    await write_coalescer.flush(user_id)
     
-    for idx, user in enumerate(leaderboard, 1):
-        name = user['first_name'] or user['username'] or f"User {user['user_id']}"
-        total = user['total']
-        medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else f"{idx}."
-        leaderboard_text += f"{medal} {name}: {total:,}\n"
+    if chat.type == chat.PRIVATE:
+        await show_leaderboard(update, user_id)
+        return
     
-    user_rank = db.get_user_rank(user_id)
-    if user_rank:
-        user_total = db.get_user_total(user_id)
-        leaderboard_text += f"\n📍 Ваша позиция: #{user_rank} ({user_total:,} подтягиваний)"
+    # Участники чата записываются до обработчиков команд (group_chats.track_chat_members)
+    rows = await adb.get_chat_leaderboard(chat.id, user_id, LEADERBOARD_PAGE_SIZE)
+    if not rows:
+        await update.message.reply_text(
+            "📊 В этом чате пока нет участников челленджа. "
+            "Напиши боту /start в личном чате и добавь подтягивания! 💪"
+        )
+        return
     
-    await update.message.reply_text(
-        leaderboard_text,
-        reply_markup=get_main_keyboard()
+    leaderboard = [row for row in rows if row['rank'] <= LEADERBOARD_PAGE_SIZE]
+    leaderboard_text = format_leaderboard(
+        leaderboard, highlight=user_id, title=f"РЕЙТИНГ ЧАТА «{chat.title}»"
     )
+    mine = next((row for row in rows if row['user_id'] == user_id), None)
+    if mine:
+        leaderboard_text += (
+            f"\n📍 Ваша позиция в чате: #{mine['rank']} из {mine['members']} "
+            f"({mine['total']:,} подтягиваний)"
+        )
+    else:
+        leaderboard_text += "\n📍 Вас нет в рейтинге: напиши боту /start в личном чате"
+    
+    await update.message.reply_text(leaderboard_text)
+
+
+async def get_leaderboard_top():
+    """Первая страница лидерборда из кэша: (строки, текст, место первой строки, есть ли дальше)"""
+    leaderboard, leaderboard_text = await leaderboard_cache.get()
+    return leaderboard, leaderboard_text, 1, len(leaderboard) == LEADERBOARD_PAGE_SIZE
+
+
+async def get_leaderboard_view(action, key, user_id):
+    """Страница лидерборда для кнопки: (строки, текст или None, место первой строки, есть ли дальше)"""
+    if action == 'next':
+        # Лишняя строка показывает, есть ли следующая страница
+        leaderboard = await adb.get_leaderboard_page(after=key, limit=LEADERBOARD_PAGE_SIZE + 1)
+        has_next = len(leaderboard) > LEADERBOARD_PAGE_SIZE
+        leaderboard = leaderboard[:LEADERBOARD_PAGE_SIZE]
+    elif action == 'prev':
+        leaderboard = await adb.get_leaderboard_page(before=key, limit=LEADERBOARD_PAGE_SIZE)
+        has_next = True
+        if len(leaderboard) < LEADERBOARD_PAGE_SIZE:
+            # Перед ключом меньше страницы строк - это первая страница
+            return await get_leaderboard_top()
+    elif action == 'me':
+        leaderboard = await adb.get_leaderboard_around(
+            user_id, LEADERBOARD_AROUND, LEADERBOARD_AROUND + 1
+        )
+        mine = next((i for i, row in enumerate(leaderboard) if row['user_id'] == user_id), 0)
+        has_next = len(leaderboard) > mine + LEADERBOARD_AROUND + 1
+        leaderboard = leaderboard[:mine + LEADERBOARD_AROUND + 1]
+    else:
+        return await get_leaderboard_top()
+    
+    if not leaderboard:
+        return [], None, 1, False
+    # Место первой строки - из рейтинга в памяти, без подсчета строк в БД
+    start = await ranking.get_user_rank(leaderboard[0]['user_id']) or 1
+    return leaderboard, None, start, has_next
+
+
+@metrics.track_handler
+async def leaderboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопок лидерборда: листает страницы, редактируя то же сообщение"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    action, *key = query.data.split(':')[1:]
+    try:
+        key = (int(key[0]), int(key[1])) if key else None
+    except (ValueError, IndexError):
+        await query.answer()
+        return
+    
+    leaderboard, leaderboard_text, start, has_next = await get_leaderboard_view(action, key, user_id)
+    if not leaderboard:
+        if action == 'me':
+            await query.answer("Вас пока нет в рейтинге. Добавь подтягивания! 💪")
+        else:
+            await query.answer("Дальше в рейтинге никого нет")
+        return
+    await query.answer()
+    
+    if leaderboard_text is None:
+        leaderboard_text = format_leaderboard(leaderboard, start, highlight=user_id)
+    
+    try:
+        await query.edit_message_text(
+            await add_user_position(leaderboard_text, user_id),
+            reply_markup=get_leaderboard_keyboard(leaderboard, start, has_next)
+        )
+    except BadRequest as e:
+        # Та же страница (например, "Топ" на первой странице) - править нечего
+        if 'not modified' not in str(e).lower():
+            raise
 
 
 async def show_today_stats(update: Update, user_id: int):
     """Показывает статистику за сегодня"""
-    today_count = db.get_today_pullups(user_id)
-    total = db.get_user_total(user_id)
+    today_count = await adb.get_today_pullups(user_id)
+    total = await adb.get_user_total(user_id)
     
     today_text = (
         f"📅 Статистика за сегодня:\n\n"
@@ -249,41 +474,197 @@ async def show_rules(update: Update):
     )
 
 
-async def undo_last(update: Update, user_id: int):
-    """Отменяет последнее добавление подтягиваний"""
-    last_pullup = db.get_last_pullup(user_id)
+async def undo_last(update: Update, user_id: int, steps: int = 1):
+    """Отменяет последние добавления подтягиваний"""
+    summary = await adb.undo_last_pullups(user_id, steps)
+    
+    if summary is None:
+        await update.message.reply_text(
+            "❌ Ошибка при отмене. Попробуй еще раз.",
+            reply_markup=get_main_keyboard()
+        )
+        return
     
-    if not last_pullup:
+    if not summary['removed_entries']:
         await update.message.reply_text(
             "❌ Нет записей для отмены",
             reply_markup=get_main_keyboard()
         )
         return
     
-    # Удаляем последнюю запись
-    success = db.delete_pullup(last_pullup['id'])
+    if summary['removed_entries'] == 1:
+        undone = f"↩️ Отменено добавление {summary['removed_count']} подтягиваний"
+    else:
+        undone = (
+            f"↩️ Отменено записей: {summary['removed_entries']} "
+            f"({summary['removed_count']} подтягиваний)"
+        )
     
-    if success:
-        total = db.get_user_total(user_id)
-        today = db.get_today_pullups(user_id)
-        
-        response = (
-            f"↩️ Отменено добавление {last_pullup['count']} подтягиваний\n\n"
-            f"📅 Сегодня: {today}\n"
-            f"📊 Всего: {total:,}"
+    response = (
+        f"{undone}\n\n"
+        f"📅 Сегодня: {summary['today']}\n"
+        f"📊 Всего: {summary['total']:,}"
+    )
+    
+    await update.message.reply_text(
+        response,
+        reply_markup=get_main_keyboard()
+    )
+
+
+@metrics.track_handler
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /undo [N]: отменяет последние N записей"""
+    args = context.args or []
+    steps = int(args[0]) if args and args[0].isdecimal() else 1
+    
+    if not 1 <= steps <= MAX_UNDO_STEPS:
+        await update.message.reply_text(
+            f"❌ Можно отменить от 1 до {MAX_UNDO_STEPS} записей за раз, например: /undo 3",
+            reply_markup=get_main_keyboard()
         )
+        return
+    
+    await write_coalescer.flush(update.effective_user.id)
+    await undo_last(update, update.effective_user.id, steps)
+
+
+@metrics.track_handler
+async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /remind: время и часовой пояс напоминаний"""
+    user_id = update.effective_user.id
+    args = context.args or []
+    
+    if not args:
+        settings = await adb.get_reminder_settings(user_id)
+        if settings is None:
+            await update.message.reply_text("Сначала отправь /start 🙂")
+            return
         
+        if settings['reminder_time']:
+            current = settings['reminder_time'].strftime('%H:%M')
+        else:
+            current = f"{reminders.get_default_reminder_time().strftime('%H:%M')} (по умолчанию)"
         await update.message.reply_text(
-            response,
+            f"⏰ Напоминания: {current}, часовой пояс {settings['timezone']}\n\n"
+            f"Изменить: /remind 20:30 или /remind 20:30 Europe/Moscow\n"
+            f"Вернуть время по умолчанию: /remind default",
             reply_markup=get_main_keyboard()
         )
+        return
+    
+    if args[0].lower() == 'default':
+        reminder_time = None
     else:
-        await update.message.reply_text(
-            "❌ Ошибка при отмене. Попробуй еще раз.",
-            reply_markup=get_main_keyboard()
+        reminder_time = reminders.parse_reminder_time(args[0])
+        if reminder_time is None:
+            await update.message.reply_text("❌ Укажи время в формате ЧЧ:ММ, например: /remind 20:30")
+            return
+    
+    timezone = None
+    if len(args) > 1:
+        timezone = args[1]
+        try:
+            ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError, OSError):
+            await update.message.reply_text(
+                "❌ Неизвестный часовой пояс. Пример: Europe/Moscow, Asia/Almaty, UTC"
+            )
+            return
+    
+    if not await adb.set_reminder_settings(user_id, reminder_time, timezone):
+        await update.message.reply_text("Сначала отправь /start 🙂")
+        return
+    
+    when = reminder_time.strftime('%H:%M') if reminder_time else "по умолчанию"
+    await update.message.reply_text(
+        f"✅ Напоминания: {when}" + (f", часовой пояс {timezone}" if timezone else ""),
+        reply_markup=get_main_keyboard()
+    )
+
+
+def format_stats():
+    """Сводка метрик бота для администраторов"""
+    def top(histogram, errors, limit):
+        snapshot = sorted(histogram.snapshot().items(), key=lambda item: -item[1][1])[:limit]
+        return [
+            f"• {name}: {count}, p95 ≤{p95 * 1000:g} мс, ошибок {errors.get(name)}"
+            for (name,), (count, _, p95) in snapshot
+        ]
+    
+    lines = ["📈 Метрики бота\n", "Обработчики (вызовов, p95, ошибок):"]
+    lines += top(metrics.HANDLER_DURATION, metrics.HANDLER_ERRORS, 10) or ["• нет данных"]
+    lines += ["", "БД, по суммарному времени (вызовов, p95, ошибок):"]
+    lines += top(metrics.DB_QUERY_DURATION, metrics.DB_ERRORS, 8) or ["• нет данных"]
+    
+    acquire = metrics.DB_CONNECTION_ACQUIRE.snapshot().get(())
+    if acquire:
+        lines.append(f"Ожидание соединения из пула: p95 ≤{acquire[2] * 1000:g} мс")
+    
+    cache = leaderboard_cache.stats()
+    coalescer = write_coalescer.stats()
+    lines += [
+        "",
+        f"Кэш лидерборда: попаданий {cache['hits']}, промахов {cache['misses']}",
+        f"Буфер записей: записей {coalescer['entries']}, сэкономлено запросов {coalescer['writes_saved']}",
+        f"Напоминания: отправлено {metrics.REMINDER_MESSAGES.get('sent')}, "
+        f"ошибок {metrics.REMINDER_MESSAGES.get('failed')}, "
+        f"заблокировали {metrics.REMINDER_MESSAGES.get('blocked')}, "
+        f"ожидание лимитов {metrics.REMINDER_THROTTLE_WAIT.get():.1f} с",
+    ]
+    change_lag = metrics.CHANGE_LAG.snapshot().get(())
+    if change_lag:
+        lines.append(
+            f"Изменения других экземпляров: применено {metrics.CHANGE_EVENTS.get('applied')}, "
+            f"задержка p95 ≤{change_lag[2] * 1000:g} мс, "
+            f"переподключений {metrics.CHANGE_LISTENER_RECONNECTS.get()}"
         )
+    return "\n".join(lines)
+
+
+@metrics.track_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats: прогресс, а администраторам - метрики бота"""
+    user_id = update.effective_user.id
+    await write_coalescer.flush(user_id)
+    
+    if user_id not in config.ADMIN_USER_IDS:
+        await show_progress(update, user_id)
+        return
+    
+    await update.message.reply_text(format_stats(), reply_markup=get_main_keyboard())
 
 
+def resync_caches():
+    """Сверяет рейтинг и лидерборд с БД после пропущенных уведомлений об изменениях;
+    возвращает снимок БД, по которому сверен рейтинг"""
+    snapshot = ranking.resync()
+    leaderboard_cache.invalidate()
+    return snapshot
+
+
+def setup_metrics():
+    """Метрики кэша, буфера записей и лидерства в задачах и HTTP-сервер /metrics"""
+    metrics.Gauge(
+        'leaderboard_cache_events', 'Счетчики кэша лидерборда', ['event'],
+        func=lambda: {(name,): value for name, value in leaderboard_cache.stats().items()}
+    )
+    metrics.Gauge(
+        'write_coalescer_entries', 'Счетчики буфера записей', ['kind'],
+        func=lambda: {(name,): value for name, value in write_coalescer.stats().items()}
+    )
+    metrics.Gauge(
+        'job_leader', 'Периодические задачи, которые выполняет этот экземпляр', ['job'],
+        func=lambda: {(name,): 1 for name in db.held_job_locks()}
+    )
+    if config.METRICS_PORT:
+        try:
+            metrics.start_http_server(config.METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик на порту {config.METRICS_PORT}: {e}")
+
+
+@metrics.track_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех текстовых сообщений"""
     text = update.message.text
@@ -293,6 +674,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_button(update, context)
     else:
         # Пытаемся обработать как число для добавления
+        metrics.label_handler('handle_add_pullups')
         await handle_add_pullups(update, context)
 
 
@@ -307,6 +689,14 @@ def main():
         logger.error("DATABASE_URL не установлен! Установите его в переменных окружения.")
         return
     
+    if config.BOT_MODE not in ('polling', 'webhook'):
+        logger.error(f"Неизвестный BOT_MODE: {config.BOT_MODE}. Допустимо: polling, webhook.")
+        return
+    
+    if config.BOT_MODE == 'webhook' and not config.WEBHOOK_URL:
+        logger.error("WEBHOOK_URL не установлен! Он нужен для BOT_MODE=webhook.")
+        return
+    
     # Инициализация базы данных
     try:
         db.init_database()
@@ -314,12 +704,32 @@ def main():
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         return
     
+    async def post_stop(application: Application):
+        """Записывает буферы до остановки бота, пока еще можно ответить пользователям"""
+        await write_coalescer.flush_all()
+    
     # Создание приложения
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .post_stop(post_stop)
+    )
+    if config.UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(config.UPDATE_CONCURRENCY))
+    application = builder.build()
     
-    # Регистрация обработчиков
+    # Регистрация обработчиков; участники групповых чатов запоминаются до остальных обработчиков
+    application.add_handler(TypeHandler(Update, group_chats.track_chat_members), group=-1)
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("remind", remind_command))
+    application.add_handler(CommandHandler("undo", undo_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("top", top_command))
+    application.add_handler(CallbackQueryHandler(leaderboard_callback, pattern=r'^lb:'))
+    # Числа и кнопки - только в личном чате, иначе бот отвечал бы на каждое сообщение группы
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_message)
+    )
     
     # Обработчик ошибок
     async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -335,9 +745,39 @@ def main():
     # Настройка напоминаний
     reminders.setup_reminders(application)
     
+    # Рейтинг в памяти и его сверка с БД
+    ranking.setup_ranking(application)
+    
+    # Старые записи сворачиваются в суммы по дням, партиции создаются заранее
+    compaction.setup_compaction(application)
+    compaction.setup_partitions(application)
+    db.add_write_listener(leaderboard_cache.on_write)
+    
+    # Записи других экземпляров бота приходят через LISTEN/NOTIFY
+    listener = change_listener.setup_change_listener(db.dispatch_write, resync_caches)
+    
+    # Метрики: /metrics для Prometheus и /stats для администраторов
+    setup_metrics()
+    
     # Запуск бота
-    logger.info("Бот запущен")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Бот запущен в режиме {config.BOT_MODE}")
+    try:
+        if config.BOT_MODE == 'webhook':
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=config.PORT,
+                url_path=config.WEBHOOK_PATH,
+                webhook_url=f"{config.WEBHOOK_URL}/{config.WEBHOOK_PATH}",
+                secret_token=config.WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        if listener is not None:
+            listener.stop()
+        adb.shutdown()
+        db.close_pool()
 
 
 if __name__ == '__main__':
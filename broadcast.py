@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from telegram.error import Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate отправок в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет свободный токен; возвращает время ожидания в секундах"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (ответ RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 0
+
+
+class FanOut:
+    """Рассылка сообщений с ограничением скорости и параллельности.
+
+    Глобальный лимит и лимит на чат соблюдаются через TokenBucket, при RetryAfter
+    вся рассылка ставится на паузу, заблокировавшие бота пользователи
+    (Forbidden) собираются в blocked, чтобы их пометили неактивными.
+    """
+
+    def __init__(self, bot, rate=30, per_chat_rate=1, concurrency=10, max_retries=3):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate)
+        self._chats = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.blocked = []
+        self.throttle_wait = 0.0
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        return bucket
+
+    async def _send(self, chat_id, text):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+            self.throttle_wait += await self._chat_bucket(chat_id).acquire()
+            self.throttle_wait += await self._global.acquire()
+            started = time.perf_counter()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self.latencies.append(time.perf_counter() - started)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                logger.warning(f"Telegram просит подождать {e.retry_after} с")
+                self._global.pause(e.retry_after)
+            except Forbidden:
+                self.blocked.append(chat_id)
+                return
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Сетевая ошибка при отправке пользователю {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error(f"Ошибка при отправке пользователю {chat_id}: {e}")
+                self.failed += 1
+                return
+        logger.error(f"Не удалось отправить сообщение пользователю {chat_id} после {self.max_retries} повторов")
+        self.failed += 1
+
+    async def _worker(self, queue):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                await self._send(*item)
+            finally:
+                queue.task_done()
+
+    async def send_all(self, messages):
+        """Отправляет пары (chat_id, text) и возвращает сводку.
+
+        Можно вызывать несколько раз подряд (рассылка частями): сводка и
+        ограничение скорости общие для всех вызовов.
+        """
+        started = time.perf_counter()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            for message in messages:
+                await queue.put(message)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        self.elapsed += time.perf_counter() - started
+        summary = self.summary(self.elapsed)
+        logger.info(
+            f"Рассылка завершена за {summary['elapsed']:.1f} с: отправлено {summary['sent']}, "
+            f"ошибок {summary['failed']}, заблокировали бота {summary['blocked']}, "
+            f"повторов {summary['retries']}, {summary['throughput']:.1f} сообщ./с, "
+            f"p95 отправки {summary['p95_latency'] * 1000:.0f} мс, "
+            f"ожидание лимитов {summary['throttle_wait']:.1f} с"
+        )
+        return summary
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        return {
+            'elapsed': elapsed,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': len(self.blocked),
+            'retries': self.retries,
+            'throughput': self.sent / elapsed if elapsed > 0 else 0.0,
+            'p95_latency': p95,
+            'throttle_wait': self.throttle_wait,
+        }
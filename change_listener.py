@@ -0,0 +1,153 @@
+import json
+import logging
+import select
+import threading
+import time
+import database as db
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeListener:
+    """Применяет к кэшам этого экземпляра изменения сумм, записанные другими экземплярами.
+
+    Слушает канал db.CHANGES_CHANNEL на отдельном соединении в фоновом потоке.
+    Свои записи экземпляр применяет сразу после коммита, поэтому в уведомлениях
+    они пропускаются. Уведомления за время разрыва соединения теряются, поэтому
+    после каждого подключения вызывается resync, сверяющий кэши с БД целиком.
+    Подписка начинается до сверки, и события транзакций, уже вошедших в снимок
+    сверки, приходят после нее: они пропускаются по номеру транзакции.
+    """
+
+    def __init__(self, apply, resync, origin=db.INSTANCE_NAME, poll_interval=5.0):
+        self._apply = apply    # apply(user_id, delta)
+        self._resync = resync  # resync() после (пере)подключения -> снимок БД или None
+        self.origin = origin
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        self._clock_offset = 0.0  # часы БД минус локальные часы, секунды
+        self._snapshot = None     # (xmin, xmax, xip) снимка последней сверки
+        self.connected = False
+        self.last_lag = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='change-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                delay = 1
+                self._listen()
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                metrics.CHANGE_LISTENER_RECONNECTS.inc()
+                logger.warning(
+                    f"Соединение для уведомлений об изменениях потеряно: {str(e).strip()}, "
+                    f"переподключение через {delay} с"
+                )
+            finally:
+                self._close()
+            self._stop.wait(delay)
+            delay = min(delay * 2, 30)
+
+    def _connect(self):
+        self._conn = db.open_dedicated_connection('pullups-bot-listener')
+        with self._conn.cursor() as cur:
+            cur.execute(f"LISTEN {db.CHANGES_CHANNEL}")
+            # Время событий ставят часы БД; задержка считается с поправкой на их расхождение
+            started = time.time()
+            cur.execute("SELECT extract(epoch FROM clock_timestamp())")
+            db_now = float(cur.fetchone()[0])
+            self._clock_offset = db_now - (started + time.time()) / 2
+        self.connected = True
+        logger.info(f"Подписка на изменения в канале {db.CHANGES_CHANNEL} установлена")
+
+        self._snapshot = None
+        try:
+            self._snapshot = _parse_snapshot(self._resync())
+        except Exception as e:
+            logger.error(f"Ошибка при сверке кэшей после подключения: {e}")
+
+    def _listen(self):
+        conn = self._conn
+        while not self._stop.is_set():
+            ready, _, _ = select.select([conn], [], [], self.poll_interval)
+            if ready:
+                conn.poll()
+            else:
+                # Тишина в канале: проверяем, что соединение живо
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            while conn.notifies:
+                self._handle(conn.notifies.pop(0).payload)
+
+    def _handle(self, payload):
+        try:
+            event = json.loads(payload)
+            user_id = int(event['u'])
+            delta = int(event['d'])
+            sent_at = float(event['t'])
+            # "x" нет у событий, отправленных до миграции 10
+            xid = int(event['x']) if 'x' in event else None
+        except (ValueError, KeyError, TypeError):
+            metrics.CHANGE_EVENTS.inc('invalid')
+            logger.warning(f"Неверное уведомление об изменении: {payload}")
+            return
+
+        lag = max(0.0, time.time() + self._clock_offset - sent_at)
+        self.last_lag = lag
+        metrics.CHANGE_LAG.observe(lag)
+        if event.get('o') == self.origin:
+            metrics.CHANGE_EVENTS.inc('own')
+            return
+        if xid is not None and self._snapshot is not None and _in_snapshot(xid, self._snapshot):
+            # Изменение уже учтено сверкой
+            metrics.CHANGE_EVENTS.inc('resynced')
+            return
+        self._apply(user_id, delta)
+        metrics.CHANGE_EVENTS.inc('applied')
+
+    def _close(self):
+        self.connected = False
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _parse_snapshot(text):
+    """Разбирает снимок pg_current_snapshot() "xmin:xmax:xip,..." в (xmin, xmax, xip)"""
+    if not text:
+        return None
+    xmin, xmax, xip = text.split(':')
+    return int(xmin), int(xmax), frozenset(int(x) for x in xip.split(',') if x)
+
+
+def _in_snapshot(xid, snapshot):
+    """Видна ли в снимке завершенная транзакция xid (как pg_visible_in_snapshot)"""
+    xmin, xmax, xip = snapshot
+    return xid < xmin or (xid < xmax and xid not in xip)
+
+
+def setup_change_listener(apply, resync):
+    """Запускает слушатель изменений, если он включен; возвращает его или None"""
+    if not config.CHANGE_LISTENER_ENABLED:
+        return None
+    listener = ChangeListener(apply, resync)
+    listener.start()
+    return listener
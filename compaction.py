@@ -0,0 +1,67 @@
+import logging
+from datetime import date, timedelta
+import database_async as adb
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def get_compaction_cutoff(today=None):
+    """Дата, записи раньше которой уплотняются"""
+    return (today or date.today()) - timedelta(days=config.PULLUPS_COMPACT_AFTER_DAYS)
+
+
+async def compact_job(context):
+    """Ежесуточное уплотнение старых записей pullups в pullups_daily (только на лидере)"""
+    try:
+        if not await adb.try_acquire_job_lock('compact_pullups'):
+            return
+        removed = await adb.compact_pullups(get_compaction_cutoff())
+        logger.info(f"Уплотнение записей завершено: удалено {removed}")
+    except Exception as e:
+        logger.error(f"Ошибка при уплотнении записей: {e}")
+
+
+def setup_compaction(application):
+    """Настраивает ежесуточное уплотнение, если оно включено"""
+    if config.PULLUPS_COMPACT_AFTER_DAYS <= 0:
+        return
+    
+    job_queue = application.job_queue
+    if job_queue:
+        job_queue.run_repeating(
+            compact_job,
+            interval=24 * 60 * 60,
+            first=10 * 60,
+            name="compact_pullups"
+        )
+        logger.info(f"Записи старше {config.PULLUPS_COMPACT_AFTER_DAYS} дней будут уплотняться раз в сутки")
+    else:
+        logger.warning("Job queue не доступен, уплотнение записей не будет работать")
+
+
+async def partition_job(context):
+    """Ежесуточное создание партиций pullups на следующие месяцы (только на лидере)"""
+    try:
+        if not await adb.try_acquire_job_lock('pullups_partitions'):
+            return
+        await adb.ensure_pullups_partitions()
+    except Exception as e:
+        logger.error(f"Ошибка при создании партиций pullups: {e}")
+
+
+def setup_partitions(application):
+    """Настраивает ежесуточное создание партиций, если pullups секционирована"""
+    if not config.PULLUPS_PARTITIONED:
+        return
+    
+    job_queue = application.job_queue
+    if job_queue:
+        job_queue.run_repeating(
+            partition_job,
+            interval=24 * 60 * 60,
+            first=60,
+            name="pullups_partitions"
+        )
+    else:
+        logger.warning("Job queue не доступен, новые партиции pullups не будут создаваться")
@@ -7,12 +7,56 @@ load_dotenv()
 # Telegram Bot Token
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Bot mode: polling (бот сам опрашивает Telegram) или webhook (Telegram присылает
+# обновления на встроенный HTTP-сервер по адресу WEBHOOK_URL)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный адрес сервиса, например https://my-bot.up.railway.app
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+# Секрет, который Telegram передает в заголовке каждого запроса вебхука
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or None
+# Railway передает порт HTTP-сервера в переменной PORT
+PORT = int(os.getenv('PORT', '8443'))
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - по очереди);
+# 1 - строго последовательно
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))
+
 # Database
 # Railway может предоставить postgres://, но psycopg2 требует postgresql://
 database_url = os.getenv('DATABASE_URL', '')
 if database_url and database_url.startswith('postgres://'):
     database_url = database_url.replace('postgres://', 'postgresql://', 1)
 DATABASE_URL = database_url
+# Необязательная реплика для чтения: лидерборд, статистика и напоминания читаются из нее
+read_url = os.getenv('DATABASE_READ_URL', '')
+if read_url and read_url.startswith('postgres://'):
+    read_url = read_url.replace('postgres://', 'postgresql://', 1)
+DATABASE_READ_URL = read_url
+# Сколько секунд после своей записи пользователь читает из основной БД, а не из реплики
+DB_READ_YOUR_WRITES_WINDOW = float(os.getenv('DB_READ_YOUR_WRITES_WINDOW', '10'))
+
+# Получать через LISTEN/NOTIFY изменения сумм, записанные другими экземплярами бота,
+# и обновлять по ним рейтинг и кэш лидерборда
+CHANGE_LISTENER_ENABLED = os.getenv('CHANGE_LISTENER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Пул соединений с БД
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+# Сколько секунд ждать свободное соединение, когда пул исчерпан
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Соединение, простоявшее дольше этого (сек), проверяется SELECT 1 перед выдачей
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+# Потоки, в которых асинхронные обработчики выполняют запросы к БД
+DB_WORKERS = int(os.getenv('DB_WORKERS', str(DB_POOL_MAX_SIZE)))
+
+# Журнал медленных запросов: запросы дольше порога (мс) пишутся с параметрами и планом
+# EXPLAIN в файл с ротацией; 0 - выключено
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '0'))
+# Доля медленных запросов, для которых снимается план (EXPLAIN ANALYZE повторяет запрос)
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv('SLOW_QUERY_SAMPLE_RATE', '1.0'))
+SLOW_QUERY_LOG_FILE = os.getenv('SLOW_QUERY_LOG_FILE', 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5'))
 
 # Challenge settings
 CHALLENGE_START_DATE = datetime.strptime(
@@ -24,7 +68,57 @@ CHALLENGE_END_DATE = datetime.strptime(
     '%Y-%m-%d'
 ).date()
 CHALLENGE_TARGET = int(os.getenv('CHALLENGE_TARGET', '18250'))
+# План на день: по нему считается отставание в прогрессе и в напоминаниях
+DAILY_PLAN = int(os.getenv('DAILY_PLAN', '50'))
+
+# Partitioning settings
+# Создавать pullups секционированной по месяцам (с BRIN-индексами по датам); уже
+# существующая обычная таблица переносится командой python maintenance.py partition-pullups
+PULLUPS_PARTITIONED = os.getenv('PULLUPS_PARTITIONED', 'false').lower() in ('1', 'true', 'yes')
+# На сколько месяцев вперед заранее создаются партиции
+PULLUPS_PARTITIONS_AHEAD = int(os.getenv('PULLUPS_PARTITIONS_AHEAD', '3'))
+
+# Compaction settings
+# Записи pullups старше стольких дней сворачиваются в суммы по дням (pullups_daily) и
+# удаляются раз в сутки; 0 - не уплотнять. Уплотненные записи нельзя отменить через /undo
+PULLUPS_COMPACT_AFTER_DAYS = int(os.getenv('PULLUPS_COMPACT_AFTER_DAYS', '0'))
 
 # Reminder settings
 REMINDER_TIME = os.getenv('REMINDER_TIME', '09:00')
+# Пользователи без своего времени распределяются по стольким минутам после REMINDER_TIME
+REMINDER_SPREAD_MINUTES = int(os.getenv('REMINDER_SPREAD_MINUTES', '60'))
+# Кому отправлять напоминания, через запятую:
+#   not_logged_today - еще ничего не записал сегодня
+#   active_days=N    - был активен (запись или регистрация) за последние N дней
+#   behind_plan      - отстает от плана DAILY_PLAN в день
+#   all              - всем активным пользователям
+REMINDER_POLICY = os.getenv('REMINDER_POLICY', 'not_logged_today')
+
+# Broadcast settings (лимиты Telegram: ~30 сообщений/с всего, ~1 сообщение/с в один чат)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+BROADCAST_PER_CHAT_RATE = float(os.getenv('BROADCAST_PER_CHAT_RATE', '1'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+
+# Ranking settings
+# Как часто (сек) рейтинг в памяти сверяется с БД
+RANK_RECONCILE_INTERVAL = int(os.getenv('RANK_RECONCILE_INTERVAL', '600'))
+
+# Leaderboard cache settings
+# Максимальная устарелость (сек) закэшированного топа лидерборда
+LEADERBOARD_CACHE_TTL = float(os.getenv('LEADERBOARD_CACHE_TTL', '30'))
+
+# Write coalescing settings
+# Числа одного пользователя, присланные подряд за столько секунд, записываются
+# одной вставкой с одним ответом; 0 - записывать каждое сразу
+WRITE_COALESCE_WINDOW = float(os.getenv('WRITE_COALESCE_WINDOW', '0'))
+# Буфер сбрасывается раньше, если в нем набралось столько записей
+WRITE_COALESCE_MAX_ENTRIES = int(os.getenv('WRITE_COALESCE_MAX_ENTRIES', '20'))
 
+# Metrics settings
+# Порт HTTP-сервера с метриками Prometheus (/metrics); 0 - не запускать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Telegram ID администраторов через запятую: им /stats показывает метрики бота
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()
+}
@@ -1,17 +1,327 @@
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.errorcodes import READ_ONLY_SQL_TRANSACTION
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+from collections import deque
 from datetime import date, datetime
-from config import DATABASE_URL, CHALLENGE_START_DATE, CHALLENGE_END_DATE, CHALLENGE_TARGET
+from config import (
+    DATABASE_URL, DATABASE_READ_URL, DB_READ_YOUR_WRITES_WINDOW, CHALLENGE_START_DATE, CHALLENGE_END_DATE, CHALLENGE_TARGET, DAILY_PLAN,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL,
+    SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_SAMPLE_RATE, SLOW_QUERY_LOG_FILE,
+    SLOW_QUERY_LOG_MAX_BYTES, SLOW_QUERY_LOG_BACKUPS,
+    PULLUPS_PARTITIONED, PULLUPS_PARTITIONS_AHEAD
+)
 import logging
+import logging.handlers
+import os
+import random
+import socket
+import threading
+import time
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Ошибки, которые функции ниже логируют и не пробрасывают, тоже попадают в метрики
+logger.addHandler(metrics.ErrorLogCounter(metrics.DB_ERRORS))
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой живости при выдаче"""
+
+    def __init__(self, dsn, min_size, max_size, timeout, healthcheck_interval, **connect_kwargs):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.closed = False
+        self._connect_kwargs = connect_kwargs
+        self._idle = deque()  # (соединение, время последнего возврата)
+        self._issued = set()  # выданные и еще не возвращенные соединения
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, **self._connect_kwargs)
+
+    def _is_alive(self, conn, last_used):
+        """Проверяет, что соединение пережило простой (например, рестарт сервера)"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        """Выдает соединение, ожидая свободного не дольше timeout секунд"""
+        if self.closed:
+            raise PoolError("Пул соединений закрыт")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"Нет свободных соединений в пуле за {self.timeout} с")
+        
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = self._connect()
+                    self._issued.add(conn)
+                    return conn
+                conn, last_used = item
+                if self._is_alive(conn, last_used):
+                    self._issued.add(conn)
+                    return conn
+                logger.warning("Соединение с БД потеряно, переподключаемся")
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Возвращает соединение в пул, откатывая незавершенную транзакцию"""
+        self._issued.discard(conn)
+        try:
+            if self.closed or conn.closed:
+                self._discard(conn)
+                return
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)
+                return
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                    return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def owns(self, conn):
+        """Выдано ли соединение этим пулом"""
+        return conn in self._issued
+
+    def closeall(self):
+        """Закрывает все простаивающие соединения; выданные закроются при возврате"""
+        self.closed = True
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+slow_query_logger = logging.getLogger('slow_queries')
+
+
+class _TracingCursorMixin:
+    """Замеряет каждый execute и записывает медленные запросы в журнал"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = time.perf_counter() - started
+        if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS and random.random() < SLOW_QUERY_SAMPLE_RATE:
+            _trace_slow_query(self, query, vars, elapsed)
+        return result
+
+
+_tracing_cursor_classes = {}
+
+
+def _tracing_cursor_class(base):
+    cls = _tracing_cursor_classes.get(base)
+    if cls is None:
+        cls = _tracing_cursor_classes[base] = type(f"Tracing{base.__name__}", (_TracingCursorMixin, base), {})
+    return cls
+
+
+class _TracingConnection(extensions.connection):
+    """Соединение, курсоры которого (любого cursor_factory) трассируют запросы"""
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        base = cursor_factory or self.cursor_factory or extensions.cursor
+        return super().cursor(*args, cursor_factory=_tracing_cursor_class(base), **kwargs)
+
+
+def _explain(conn, statement, read_only=False):
+    """Снимает план и откатывает все, что при этом было сделано.
+
+    План снимается в точке сохранения или в отдельной транзакции, которая затем
+    откатывается. С read_only она переводится в режим только чтения: запрос,
+    который что-то пишет, падает до выполнения, и тогда возвращается None.
+    """
+    status = conn.info.transaction_status
+    if status == extensions.TRANSACTION_STATUS_INERROR:
+        return "план не снят: транзакция в состоянии ошибки"
+    in_transaction = status != extensions.TRANSACTION_STATUS_IDLE
+    
+    # Обычный курсор без трассировки, чтобы EXPLAIN сам не попал в журнал
+    cur = extensions.connection.cursor(conn)
+    try:
+        cur.execute("SAVEPOINT slow_query_explain" if in_transaction else "BEGIN")
+        try:
+            if read_only:
+                cur.execute("SET TRANSACTION READ ONLY")
+            cur.execute(statement)
+            return "\n".join(row[0] for row in cur.fetchall())
+        except psycopg2.Error as e:
+            if read_only and e.pgcode == READ_ONLY_SQL_TRANSACTION:
+                return None
+            raise
+        finally:
+            if in_transaction:
+                cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                cur.execute("RELEASE SAVEPOINT slow_query_explain")
+            else:
+                cur.execute("ROLLBACK")
+    except psycopg2.Error as e:
+        return f"план не снят: {e}"
+    finally:
+        cur.close()
+
+
+def _trace_slow_query(cur, query, vars, elapsed):
+    """Пишет медленный запрос с параметрами, временем и планом в журнал"""
+    try:
+        metrics.DB_SLOW_QUERIES.inc()
+        statement = cur.query.decode('utf-8', errors='replace')
+        keyword = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+        plan = None
+        # ANALYZE выполняет запрос еще раз, поэтому только для чистого чтения: SELECT
+        # функции записи (add_pullups_summary) и WITH с DELETE/INSERT/UPDATE в режиме
+        # только чтения падают и получают план без выполнения. Сессионную
+        # advisory-блокировку откат не снимает, такие запросы не повторяются вовсе
+        if keyword in ('select', 'with') and 'advisory' not in statement.lower():
+            plan = _explain(cur.connection, f"EXPLAIN (ANALYZE, BUFFERS) {statement}", read_only=True)
+        if plan is None:
+            if keyword in ('select', 'with', 'insert', 'update', 'delete'):
+                plan = _explain(cur.connection, f"EXPLAIN {statement}")
+            else:
+                plan = "план не снимается для этого оператора"
+        
+        slow_query_logger.warning(
+            f"{elapsed * 1000:.1f} мс\n"
+            f"{' '.join(query.split()) if isinstance(query, str) else query}\n"
+            f"параметры: {vars!r}\n"
+            f"{plan}\n"
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось записать медленный запрос: {e}")
+
+
+def _setup_slow_query_log():
+    """Журнал медленных запросов в отдельном файле с ротацией"""
+    handler = logging.handlers.RotatingFileHandler(
+        SLOW_QUERY_LOG_FILE,
+        maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+        backupCount=SLOW_QUERY_LOG_BACKUPS,
+        encoding='utf-8'
+    )
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_logger.addHandler(handler)
+    slow_query_logger.setLevel(logging.INFO)
+    slow_query_logger.propagate = False
+    logger.info(
+        f"Журнал медленных запросов: {SLOW_QUERY_LOG_FILE} "
+        f"(от {SLOW_QUERY_THRESHOLD_MS} мс, доля {SLOW_QUERY_SAMPLE_RATE})"
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Пул реплики для чтения (DATABASE_READ_URL); до _read_pool_retry_at реплика
+# считается недоступной и чтения идут в основную БД
+_read_pool = None
+_read_pool_retry_at = 0.0
+# Сколько секунд не обращаться к реплике после ошибки подключения к ней
+READ_REPLICA_RETRY_INTERVAL = 30
+# user_id -> время (monotonic) последней записи пользователя
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+
+# Имя соединений этого экземпляра (application_name): по нему в уведомлениях об
+# изменениях экземпляр узнает свои записи
+INSTANCE_NAME = f"pullups-bot-{socket.gethostname()}-{os.getpid()}"[:63]
+# Канал LISTEN/NOTIFY, в который триггеры pullups и users пишут изменения сумм
+CHANGES_CHANNEL = 'pullups_changes'
+
+
+def open_dedicated_connection(application_name):
+    """Открывает отдельное от пулов соединение с основной БД в autocommit"""
+    # keepalive: разорванное соединение обнаруживается без долгого ожидания TCP
+    conn = psycopg2.connect(
+        DATABASE_URL, application_name=application_name,
+        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+    )
+    conn.autocommit = True
+    return conn
+
+
+def _create_pool(dsn):
+    """Создает пул соединений с общими настройками DB_POOL_*"""
+    connect_kwargs = {'application_name': INSTANCE_NAME}
+    if SLOW_QUERY_THRESHOLD_MS > 0:
+        if not slow_query_logger.handlers:
+            _setup_slow_query_log()
+        connect_kwargs['connection_factory'] = _TracingConnection
+    return ConnectionPool(
+        dsn,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+        **connect_kwargs
+    )
+
+
+def _get_pool():
+    """Возвращает пул соединений, создавая его при первом обращении"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool(DATABASE_URL)
+                logger.info(f"Пул соединений создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    return _pool
+
+
+def _get_read_pool():
+    """Возвращает пул реплики, создавая его при первом обращении"""
+    global _read_pool
+    if _read_pool is None:
+        with _pool_lock:
+            if _read_pool is None:
+                _read_pool = _create_pool(DATABASE_READ_URL)
+                logger.info(f"Пул соединений реплики создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    return _read_pool
 
 
 def get_connection():
-    """Создает подключение к базе данных"""
+    """Берет подключение к базе данных из пула"""
     try:
-        return psycopg2.connect(DATABASE_URL)
+        with metrics.DB_CONNECTION_ACQUIRE.time():
+            return _get_pool().getconn()
     except psycopg2.OperationalError as e:
         logger.error(f"Ошибка подключения к базе данных: {e}")
         raise
@@ -20,24 +330,319 @@ def get_connection():
         raise
 
 
+def get_read_connection(user_id=None):
+    """Берет подключение для чтения: к реплике, если она задана и доступна.
+
+    Пользователь, который недавно что-то записал, читает из основной БД, чтобы
+    сразу видеть свои изменения, даже если реплика от нее отстает.
+    """
+    global _read_pool_retry_at
+    if not DATABASE_READ_URL:
+        return get_connection()
+    if user_id is not None and _wrote_recently(user_id):
+        metrics.DB_READS.inc('primary')
+        return get_connection()
+    if time.monotonic() < _read_pool_retry_at:
+        metrics.DB_READS.inc('fallback')
+        return get_connection()
+    
+    try:
+        with metrics.DB_CONNECTION_ACQUIRE.time():
+            conn = _get_read_pool().getconn()
+        metrics.DB_READS.inc('replica')
+        return conn
+    except psycopg2.OperationalError as e:
+        _read_pool_retry_at = time.monotonic() + READ_REPLICA_RETRY_INTERVAL
+        logger.warning(
+            f"Реплика недоступна, чтение из основной БД {READ_REPLICA_RETRY_INTERVAL} с: {e}"
+        )
+    except PoolError as e:
+        logger.warning(f"Нет свободных соединений с репликой, чтение из основной БД: {e}")
+    metrics.DB_READS.inc('fallback')
+    return get_connection()
+
+
+def _mark_written(user_id):
+    """Запоминает запись пользователя для чтения своих записей из основной БД"""
+    if not DATABASE_READ_URL:
+        return
+    now = time.monotonic()
+    with _recent_writes_lock:
+        _recent_writes[user_id] = now
+        # Старые отметки удаляются, чтобы словарь не рос вместе с числом пользователей
+        if len(_recent_writes) > 10000:
+            for key in [k for k, t in _recent_writes.items() if now - t > DB_READ_YOUR_WRITES_WINDOW]:
+                del _recent_writes[key]
+
+
+def _wrote_recently(user_id):
+    written_at = _recent_writes.get(user_id)
+    return written_at is not None and time.monotonic() - written_at < DB_READ_YOUR_WRITES_WINDOW
+
+
+def release_connection(conn):
+    """Возвращает подключение в пул, из которого оно взято"""
+    read_pool = _read_pool
+    if read_pool is not None and read_pool.owns(conn):
+        read_pool.putconn(conn)
+        return
+    pool = _pool
+    if pool is None:
+        conn.close()
+    else:
+        pool.putconn(conn)
+
+
+def close_pool():
+    """Закрывает пулы соединений при остановке бота"""
+    global _pool, _read_pool
+    release_job_locks()
+    with _pool_lock:
+        pool, _pool = _pool, None
+        read_pool, _read_pool = _read_pool, None
+    if read_pool is not None:
+        read_pool.closeall()
+    if pool is not None:
+        pool.closeall()
+        logger.info("Пул соединений закрыт")
+
+
+# Блокировки ведущего экземпляра держит отдельное от пула соединение: сессионная
+# advisory-блокировка живет, пока живо соединение, и снимается сервером, если
+# процесс-лидер упал, поэтому задачу подхватывает другой экземпляр
+JOB_LOCK_CLASS = 20250101  # первый ключ двухключевых advisory-блокировок задач
+_job_lock_conn = None
+_held_job_locks = set()
+_job_lock_mutex = threading.Lock()
+
+
+def _close_job_lock_conn():
+    global _job_lock_conn
+    conn, _job_lock_conn = _job_lock_conn, None
+    _held_job_locks.clear()
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def try_acquire_job_lock(job_name):
+    """Берет или подтверждает лидерство этого экземпляра в задаче job_name.
+
+    Возвращает True, если задачу должен выполнять этот экземпляр. Лидер держит
+    блокировку до остановки или потери соединения с БД.
+    """
+    global _job_lock_conn
+    with _job_lock_mutex:
+        for attempt in range(2):
+            try:
+                if _job_lock_conn is None or _job_lock_conn.closed:
+                    _close_job_lock_conn()
+                    _job_lock_conn = open_dedicated_connection('pullups-bot-jobs')
+                with _job_lock_conn.cursor() as cur:
+                    if job_name in _held_job_locks:
+                        # Соединение живо - значит, и блокировка все еще наша
+                        cur.execute("SELECT 1")
+                        return True
+                    cur.execute(
+                        "SELECT pg_try_advisory_lock(%s, hashtext(%s))", (JOB_LOCK_CLASS, job_name)
+                    )
+                    if not cur.fetchone()[0]:
+                        return False
+                _held_job_locks.add(job_name)
+                logger.info(f"Этот экземпляр выполняет задачу {job_name}")
+                return True
+            except psycopg2.Error as e:
+                logger.warning(f"Соединение для блокировок задач потеряно: {e}")
+                _close_job_lock_conn()
+        return False
+
+
+def release_job_locks():
+    """Отдает лидерство во всех задачах (при остановке бота)"""
+    with _job_lock_mutex:
+        if _held_job_locks:
+            logger.info(f"Лидерство в задачах снято: {', '.join(sorted(_held_job_locks))}")
+        _close_job_lock_conn()
+
+
+def held_job_locks():
+    """Задачи, в которых этот экземпляр сейчас лидер"""
+    return set(_held_job_locks)
+
+
+_write_listeners = []
+
+
+def add_write_listener(callback):
+    """Подписывает callback(user_id, delta) на изменения сумм пользователей"""
+    _write_listeners.append(callback)
+
+
+def _notify_write(user_id, delta):
+    """Сообщает подписчикам об изменении суммы пользователя после коммита"""
+    _mark_written(user_id)
+    dispatch_write(user_id, delta)
+
+
+def dispatch_write(user_id, delta):
+    """Передает подписчикам изменение суммы, в том числе сделанное другим экземпляром"""
+    for callback in _write_listeners:
+        try:
+            callback(user_id, delta)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике изменения данных: {e}")
+
+
+# Ключ advisory-блокировки, под которой применяются миграции схемы
+MIGRATIONS_LOCK_KEY = 4_815_162_342
+
+
+@metrics.track_query
 def init_database():
-    """Инициализирует базу данных, создает таблицы если их нет"""
+    """Приводит схему БД к последней версии, применяя недостающие миграции.
+
+    Если версия в schema_version совпадает с SCHEMA_VERSION, выполняется
+    один запрос и DDL не запускается. Иначе миграции применяются по порядку
+    под advisory-блокировкой, чтобы одновременно запущенные экземпляры бота
+    не выполняли их параллельно.
+    """
+    version = get_schema_version()
+    if version == SCHEMA_VERSION:
+        logger.info(f"Схема БД актуальна (версия {version})")
+        return
+    if version is not None and version > SCHEMA_VERSION:
+        logger.warning(
+            f"Версия схемы БД {version} новее известной этому коду {SCHEMA_VERSION}, миграции пропущены"
+        )
+        return
+    
     conn = get_connection()
     cur = conn.cursor()
+    # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции, поэтому сессия
+    # работает в autocommit, а транзакционные шаги открывают транзакцию сами
+    conn.autocommit = True
+    locked = False
     
     try:
-        # Таблица пользователей
+        _acquire_migrations_lock(cur)
+        locked = True
+        
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Пока ждали блокировку, часть миграций мог применить другой экземпляр
+        cur.execute("SELECT version FROM schema_version")
+        applied = {row[0] for row in cur.fetchall()}
         
-        # Таблица подтягиваний
+        for step_version, name, step, transactional in MIGRATIONS:
+            if step_version in applied:
+                continue
+            started = time.perf_counter()
+            if transactional:
+                conn.autocommit = False
+            try:
+                step(cur)
+                cur.execute(
+                    "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                    (step_version, name)
+                )
+                if transactional:
+                    conn.commit()
+            except Exception:
+                if transactional:
+                    conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
+            logger.info(
+                f"Миграция {step_version} ({name}) применена за {time.perf_counter() - started:.1f} с"
+            )
+        
+        logger.info(f"База данных инициализирована успешно (версия схемы {SCHEMA_VERSION})")
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации БД: {e}")
+        raise
+    finally:
+        try:
+            if locked:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+        except psycopg2.Error as e:
+            logger.error(f"Не удалось снять блокировку миграций: {e}")
+        finally:
+            cur.close()
+            conn.autocommit = False
+            release_connection(conn)
+
+
+def _acquire_migrations_lock(cur):
+    """Берет сессионную advisory-блокировку миграций, дожидаясь других экземпляров"""
+    # Блокировка запрашивается через pg_try_advisory_lock с паузами, а не
+    # ожиданием в pg_advisory_lock: ждущий запрос держит снимок данных, и
+    # CREATE INDEX CONCURRENTLY у держателя блокировки ждал бы его завершения
+    waiting = False
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        if cur.fetchone()[0]:
+            return
+        if not waiting:
+            logger.info("Миграции схемы выполняет другой экземпляр бота, ждем")
+            waiting = True
+        time.sleep(1)
+
+
+@metrics.track_query
+def get_schema_version():
+    """Текущая версия схемы БД или None, если миграции еще не применялись"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        return cur.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при получении версии схемы: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def _migrate_base_tables(cur):
+    """Миграция 1: таблицы users и pullups"""
+    # Таблица пользователей
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица подтягиваний: обычная или секционированная по месяцам
+    kind = _get_pullups_kind(cur)
+    if PULLUPS_PARTITIONED and kind is None:
+        cur.execute("CREATE SEQUENCE IF NOT EXISTS pullups_id_seq AS INTEGER")
+        _create_partitioned_pullups(cur, 'pullups', 'pullups_id_seq')
+        cur.execute("ALTER SEQUENCE pullups_id_seq OWNED BY pullups.id")
+        today = date.today()
+        _create_pullups_partitions(
+            cur, 'pullups',
+            min(CHALLENGE_START_DATE, today),
+            _add_months(today, PULLUPS_PARTITIONS_AHEAD)
+        )
+    else:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS pullups (
                 id SERIAL PRIMARY KEY,
@@ -47,210 +652,1754 @@ def init_database():
                 date DATE DEFAULT CURRENT_DATE
             )
         """)
+    
+    # Пользователи, заблокировавшие бота, не получают напоминаний
+    cur.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE
+    """)
+    
+    # Время напоминаний (NULL - время по умолчанию) и часовой пояс пользователя
+    cur.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS reminder_time TIME
+    """)
+    cur.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'UTC'
+    """)
+
+
+def _migrate_indexes(cur):
+    """Миграция 2: индексы users и pullups, создаются без блокировки записи"""
+    _create_index_concurrently(
+        cur, 'idx_users_reminder_slot', 'users', "(timezone, reminder_time) WHERE is_active"
+    )
+    partitioned = _get_pullups_kind(cur) == 'p'
+    for name, definition in _pullups_indexes(partitioned):
+        _create_index_concurrently(cur, name, 'pullups', definition, partitioned)
+
+
+def _create_index_concurrently(cur, name, table, definition, partitioned=False):
+    """Создает индекс через CREATE INDEX CONCURRENTLY (вне транзакции).
+
+    Индекс, оставшийся невалидным после прерванной попытки, пересоздается.
+    У секционированной таблицы индекс создается на самой таблице (ON ONLY),
+    на каждой партиции - CONCURRENTLY, и индексы партиций присоединяются к нему.
+    """
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cur.fetchone()
+    if row is not None and row[0]:
+        return
+    
+    if not partitioned:
+        if row is not None:
+            cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+        cur.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} {definition}")
+        return
+    
+    # Индекс секционированной таблицы станет валидным, когда присоединены индексы всех партиций
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname
+    """, (table,))
+    for (partition,) in cur.fetchall():
+        partition_index = f"{partition}_{name}"
+        _create_index_concurrently(cur, partition_index, partition, definition)
+        cur.execute("SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s)", (partition_index,))
+        if cur.fetchone() is None:
+            cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def _get_pullups_kind(cur):
+    """Тип таблицы pullups: 'r' - обычная, 'p' - секционированная, None - еще нет"""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('pullups')")
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row['relkind'] if isinstance(row, dict) else row[0]
+
+
+def _pullups_indexes(partitioned):
+    """Индексы pullups: пары (имя, определение); у секционированной таблицы столбцы
+    дат индексируются BRIN"""
+    if partitioned:
+        # Записи добавляются в порядке времени, поэтому BRIN по датам в сотни раз
+        # меньше B-tree, а выборки по дате сначала отсекают лишние партиции
+        indexes = [
+            ('idx_pullups_date_brin', "USING BRIN (date)"),
+            ('idx_pullups_created_brin', "USING BRIN (created_at)"),
+        ]
+    else:
+        indexes = [
+            ('idx_pullups_user_id', "(user_id)"),
+            ('idx_pullups_date', "(date)"),
+            ('idx_pullups_user_date', "(user_id, date)"),
+        ]
+    # Последние записи пользователя (отмена) без сортировки всех его строк;
+    # он же служит индексом по user_id для ON DELETE CASCADE
+    indexes.append(('idx_pullups_user_created', "(user_id, created_at DESC, id DESC)"))
+    return indexes
+
+
+def _init_pullups_indexes(cur, partitioned):
+    """Создает индексы pullups в текущей транзакции (для новой или заблокированной таблицы)"""
+    for name, definition in _pullups_indexes(partitioned):
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON pullups {definition}")
+
+
+def _create_partitioned_pullups(cur, name, sequence):
+    """Создает секционированную по месяцам таблицу pullups с партицией по умолчанию"""
+    # Ключ секционирования обязан входить в первичный ключ
+    cur.execute(f"""
+        CREATE TABLE {name} (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+            user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+            count INTEGER NOT NULL CHECK (count > 0),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            date DATE NOT NULL DEFAULT CURRENT_DATE,
+            PRIMARY KEY (id, date)
+        ) PARTITION BY RANGE (date)
+    """)
+    # Страховка для дат вне созданных месяцев; обычно пустая
+    cur.execute(f"CREATE TABLE pullups_default PARTITION OF {name} DEFAULT")
+
+
+def _add_months(day, months):
+    """Первое число месяца, отстоящего от day на months месяцев"""
+    years, month = divmod(day.month - 1 + months, 12)
+    return date(day.year + years, month + 1, 1)
+
+
+def _create_pullups_partitions(cur, parent, first_day, last_day):
+    """Создает недостающие месячные партиции pullups_ГГГГ_ММ с first_day по last_day"""
+    month = _add_months(first_day, 0)
+    while month <= last_day:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS pullups_{month:%Y_%m}
+            PARTITION OF {parent} FOR VALUES FROM (%s) TO (%s)
+        """, (month, _add_months(month, 1)))
+        month = _add_months(month, 1)
+
+
+def _init_user_totals(cur):
+    """Создает сводные таблицы pullups_daily и user_totals и триггеры, обновляющие их
+    в одной транзакции с pullups"""
+    cur.execute("SELECT to_regclass('pullups_daily') IS NULL, to_regclass('user_totals') IS NULL")
+    needs_daily_backfill, needs_backfill = cur.fetchone()
+    
+    # Суммы по дням: total и entries учитывают все записи дня, compacted_* - ту их часть,
+    # строки которой уже удалены из pullups при уплотнении
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pullups_daily (
+            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            date DATE NOT NULL,
+            total BIGINT NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            compacted_total BIGINT NOT NULL DEFAULT 0,
+            compacted_entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, date)
+        )
+    """)
+    if needs_daily_backfill:
+        cur.execute("""
+            INSERT INTO pullups_daily (user_id, date, total, entries)
+            SELECT user_id, date, SUM(count), COUNT(*)
+            FROM pullups
+            GROUP BY user_id, date
+        """)
+        logger.info("Таблица pullups_daily заполнена по данным pullups")
+    
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            total BIGINT NOT NULL DEFAULT 0,
+            records_count INTEGER NOT NULL DEFAULT 0,
+            days_count INTEGER NOT NULL DEFAULT 0,
+            today_date DATE,
+            today_total INTEGER NOT NULL DEFAULT 0,
+            last_pullup_id INTEGER,
+            last_created_at TIMESTAMP
+        )
+    """)
+    
+    # У каждого пользователя есть строка итогов, даже без записей
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION user_totals_after_user_insert() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_totals (user_id) VALUES (NEW.user_id)
+            ON CONFLICT (user_id) DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # Триггеры уровня оператора: вставка нескольких строк одним INSERT
+    # или удаление нескольких строк одним DELETE применяется одним UPDATE.
+    # Сначала меняются суммы дня в pullups_daily, затем по ним - user_totals.
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION user_totals_after_pullups_insert() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_totals (user_id)
+            SELECT DISTINCT user_id FROM new_rows
+            ON CONFLICT (user_id) DO NOTHING;
+            
+            -- Блокируем строки итогов до подсчета дней, чтобы параллельные
+            -- записи одного пользователя применялись по очереди
+            PERFORM 1 FROM user_totals
+            WHERE user_id IN (SELECT user_id FROM new_rows)
+            ORDER BY user_id
+            FOR UPDATE;
+            
+            -- Все подзапросы видят pullups_daily до вставки, поэтому новый день -
+            -- тот, которого там еще нет, а новая сумма дня возвращается из RETURNING
+            WITH days AS (
+                SELECT
+                    n.user_id,
+                    n.date,
+                    SUM(n.count) AS day_total,
+                    COUNT(*) AS records,
+                    NOT EXISTS (
+                        SELECT 1 FROM pullups_daily d
+                        WHERE d.user_id = n.user_id AND d.date = n.date
+                    ) AS is_new_day
+                FROM new_rows n
+                GROUP BY n.user_id, n.date
+            ),
+            rolled AS (
+                INSERT INTO pullups_daily AS d (user_id, date, total, entries)
+                SELECT user_id, date, day_total, records FROM days
+                ON CONFLICT (user_id, date) DO UPDATE SET
+                    total = d.total + EXCLUDED.total,
+                    entries = d.entries + EXCLUDED.entries
+                RETURNING d.user_id, d.date, d.total
+            ),
+            added AS (
+                SELECT DISTINCT ON (user_id)
+                    user_id,
+                    date AS max_date,
+                    SUM(day_total) OVER w AS total,
+                    SUM(records) OVER w AS records,
+                    COUNT(*) FILTER (WHERE is_new_day) OVER w AS new_days
+                FROM days
+                WINDOW w AS (PARTITION BY user_id)
+                ORDER BY user_id, date DESC
+            ),
+            last AS (
+                SELECT DISTINCT ON (user_id) user_id, id, created_at
+                FROM new_rows
+                ORDER BY user_id, created_at DESC, id DESC
+            )
+            UPDATE user_totals t SET
+                total = t.total + a.total,
+                records_count = t.records_count + a.records,
+                days_count = t.days_count + a.new_days,
+                today_total = CASE
+                    WHEN t.today_date IS NULL OR a.max_date >= t.today_date THEN r.total
+                    ELSE t.today_total
+                END,
+                today_date = GREATEST(t.today_date, a.max_date),
+                last_pullup_id = CASE
+                    WHEN t.last_created_at IS NULL OR l.created_at >= t.last_created_at THEN l.id
+                    ELSE t.last_pullup_id
+                END,
+                last_created_at = GREATEST(t.last_created_at, l.created_at)
+            FROM added a
+            JOIN rolled r ON r.user_id = a.user_id AND r.date = a.max_date
+            JOIN last l ON l.user_id = a.user_id
+            WHERE t.user_id = a.user_id;
+            
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # При уплотнении (compact_pullups) удаляемые записи уже учтены в pullups_daily,
+    # поэтому триггер пропускает такие удаления по флагу сессии pullups.compacting
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION user_totals_after_pullups_delete() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('pullups.compacting', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            
+            PERFORM 1 FROM user_totals
+            WHERE user_id IN (SELECT user_id FROM old_rows)
+            ORDER BY user_id
+            FOR UPDATE;
+            
+            -- Опустевшие дни удаляются, остальные уменьшаются
+            WITH days AS (
+                SELECT user_id, date, SUM(count) AS day_total, COUNT(*) AS records
+                FROM old_rows
+                GROUP BY user_id, date
+            ),
+            emptied AS (
+                DELETE FROM pullups_daily d
+                USING days x
+                WHERE d.user_id = x.user_id AND d.date = x.date AND d.entries <= x.records
+            )
+            UPDATE pullups_daily d SET
+                total = d.total - x.day_total,
+                entries = d.entries - x.records
+            FROM days x
+            WHERE d.user_id = x.user_id AND d.date = x.date AND d.entries > x.records;
+            
+            -- Последний день берется из pullups_daily, последняя запись - из pullups,
+            -- оба по индексу и только для затронутых пользователей
+            WITH removed AS (
+                SELECT
+                    o.user_id,
+                    SUM(o.count) AS total,
+                    COUNT(*) AS records,
+                    COUNT(DISTINCT o.date) FILTER (WHERE NOT EXISTS (
+                        SELECT 1 FROM pullups_daily d
+                        WHERE d.user_id = o.user_id AND d.date = o.date
+                    )) AS gone_days
+                FROM old_rows o
+                GROUP BY o.user_id
+            )
+            UPDATE user_totals t SET
+                total = t.total - r.total,
+                records_count = t.records_count - r.records,
+                days_count = t.days_count - r.gone_days,
+                today_date = d.date,
+                today_total = COALESCE(d.total, 0),
+                last_pullup_id = l.id,
+                last_created_at = l.created_at
+            FROM removed r
+            LEFT JOIN LATERAL (
+                SELECT date, total
+                FROM pullups_daily
+                WHERE user_id = r.user_id
+                ORDER BY date DESC
+                LIMIT 1
+            ) d ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT p.id, p.created_at
+                FROM pullups p
+                WHERE p.user_id = r.user_id
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT 1
+            ) l ON TRUE
+            WHERE t.user_id = r.user_id;
+            
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # CREATE OR REPLACE TRIGGER берет SHARE ROW EXCLUSIVE, а не ACCESS EXCLUSIVE, как
+    # DROP TRIGGER: он не мешает проверке внешнего ключа users у идущей вставки в
+    # pullups, и замена триггеров на работающей базе не приводит к взаимоблокировке
+    cur.execute("""
+        CREATE OR REPLACE TRIGGER trg_users_totals
+            AFTER INSERT ON users
+            FOR EACH ROW EXECUTE FUNCTION user_totals_after_user_insert();
+        
+        CREATE OR REPLACE TRIGGER trg_pullups_totals_insert
+            AFTER INSERT ON pullups
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION user_totals_after_pullups_insert();
         
-        # Индексы для быстрого поиска
+        CREATE OR REPLACE TRIGGER trg_pullups_totals_delete
+            AFTER DELETE ON pullups
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION user_totals_after_pullups_delete();
+    """)
+    
+    if needs_backfill:
+        _rebuild_user_totals(cur)
+        logger.info("Таблица user_totals заполнена по данным pullups")
+
+
+def _init_write_functions(cur):
+    """Создает функции записи, которые сразу возвращают обновленные итоги"""
+    # Пользователь создается или обновляется в той же транзакции, строка users
+    # переписывается, только если данные профиля действительно изменились.
+    # Несколько записей подряд вставляются одним INSERT в порядке массива.
+    # Итоги читаются после INSERT, когда триггер уже обновил user_totals.
+    cur.execute("""
+        DROP FUNCTION IF EXISTS add_pullups_summary(BIGINT, INTEGER, DATE, VARCHAR, VARCHAR, VARCHAR)
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION add_pullups_summary(
+            p_user_id BIGINT,
+            p_counts INTEGER[],
+            p_date DATE,
+            p_username VARCHAR,
+            p_first_name VARCHAR,
+            p_last_name VARCHAR
+        ) RETURNS TABLE (today BIGINT, total BIGINT) AS $$
+        BEGIN
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES (p_user_id, p_username, p_first_name, p_last_name)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                is_active = TRUE
+            WHERE (users.username, users.first_name, users.last_name, users.is_active)
+                IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, TRUE);
+            
+            INSERT INTO pullups (user_id, count, date)
+            SELECT p_user_id, c.count, p_date
+            FROM unnest(p_counts) WITH ORDINALITY AS c(count, n)
+            ORDER BY c.n;
+            
+            RETURN QUERY
+            SELECT
+                CASE WHEN t.today_date = CURRENT_DATE THEN t.today_total ELSE 0 END::BIGINT,
+                t.total
+            FROM user_totals t
+            WHERE t.user_id = p_user_id;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # Строка итогов блокируется до выбора записей: две быстрые отмены подряд
+    # удаляют разные записи, а не спорят за одну и ту же
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION undo_pullups_summary(
+            p_user_id BIGINT,
+            p_steps INTEGER
+        ) RETURNS TABLE (removed_count BIGINT, removed_entries BIGINT, today BIGINT, total BIGINT) AS $$
+        DECLARE
+            v_removed_count BIGINT;
+            v_removed_entries BIGINT;
+        BEGIN
+            PERFORM 1 FROM user_totals WHERE user_id = p_user_id FOR UPDATE;
+            
+            WITH deleted AS (
+                DELETE FROM pullups
+                WHERE id IN (
+                    SELECT id FROM pullups
+                    WHERE user_id = p_user_id
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT p_steps
+                )
+                RETURNING count
+            )
+            SELECT COALESCE(SUM(count), 0), COUNT(*)
+            INTO v_removed_count, v_removed_entries
+            FROM deleted;
+            
+            RETURN QUERY
+            SELECT
+                v_removed_count,
+                v_removed_entries,
+                CASE WHEN t.today_date = CURRENT_DATE THEN t.today_total ELSE 0 END::BIGINT,
+                t.total
+            FROM user_totals t
+            WHERE t.user_id = p_user_id;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def _migrate_job_runs(cur):
+    """Миграция 5: состояние периодических задач для продолжения после перезапуска"""
+    # last_completed - последний полностью выполненный запуск; in_progress и cursor -
+    # начатый запуск и последний обработанный в нем ключ (например, user_id)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_name VARCHAR(64) PRIMARY KEY,
+            last_completed TIMESTAMPTZ,
+            in_progress TIMESTAMPTZ,
+            cursor BIGINT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _init_change_notifications(cur):
+    """Миграция 6: уведомления об изменениях сумм для кэшей других экземпляров.
+
+    После коммита в канал CHANGES_CHANNEL приходит по событию на пользователя и
+    оператор: {"u": user_id, "d": изменение суммы, "o": application_name
+    записавшего, "t": время события (секунды эпохи по часам БД)}.
+    """
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION pullups_notify_changes() RETURNS trigger AS $$
+        BEGIN
+            -- Уплотнение не меняет суммы
+            IF TG_OP = 'DELETE' AND current_setting('pullups.compacting', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            
+            IF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'u', user_id, 'd', SUM(count),
+                    'o', current_setting('application_name'),
+                    't', extract(epoch FROM clock_timestamp())
+                )::text)
+                FROM new_rows
+                GROUP BY user_id;
+            ELSE
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'u', user_id, 'd', -SUM(count),
+                    'o', current_setting('application_name'),
+                    't', extract(epoch FROM clock_timestamp())
+                )::text)
+                FROM old_rows
+                GROUP BY user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # Новый пользователь появляется в рейтинге с нулевой суммой
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION users_notify_insert() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                'u', NEW.user_id, 'd', 0,
+                'o', current_setting('application_name'),
+                't', extract(epoch FROM clock_timestamp())
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    cur.execute("""
+        CREATE OR REPLACE TRIGGER trg_users_notify
+            AFTER INSERT ON users
+            FOR EACH ROW EXECUTE FUNCTION users_notify_insert();
+        
+        CREATE OR REPLACE TRIGGER trg_pullups_notify_insert
+            AFTER INSERT ON pullups
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION pullups_notify_changes();
+        
+        CREATE OR REPLACE TRIGGER trg_pullups_notify_delete
+            AFTER DELETE ON pullups
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION pullups_notify_changes();
+    """)
+
+
+def _init_streaks(cur):
+    """Создает столбцы серий в user_totals, функцию их пересчета и заменяет
+    триггерные функции pullups на ведущие серии"""
+    # Серия - дни с записями подряд, заканчивающиеся last_active_date
+    cur.execute("""
+        ALTER TABLE user_totals
+            ADD COLUMN IF NOT EXISTS current_streak INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS longest_streak INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS last_active_date DATE
+    """)
+    
+    # Пересчет серий по pullups_daily для дней задним числом, опустевших дней и
+    # всей таблицы (p_user_ids = NULL); возвращает число изменившихся строк
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION recompute_user_streaks(p_user_ids BIGINT[]) RETURNS INTEGER AS $$
+        DECLARE
+            v_changed INTEGER;
+        BEGIN
+            IF p_user_ids IS NULL THEN
+                p_user_ids := ARRAY(SELECT user_id FROM user_totals);
+            END IF;
+            
+            -- У дней одной серии дата минус номер дня по порядку одинаковая
+            WITH runs AS (
+                SELECT user_id, MAX(date) AS last_date, COUNT(*) AS length
+                FROM (
+                    SELECT
+                        user_id,
+                        date,
+                        date - (ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY date))::INTEGER AS run
+                    FROM pullups_daily
+                    WHERE user_id = ANY(p_user_ids)
+                ) d
+                GROUP BY user_id, run
+            ),
+            streaks AS (
+                SELECT DISTINCT ON (user_id)
+                    user_id,
+                    last_date,
+                    length AS current_streak,
+                    MAX(length) OVER (PARTITION BY user_id) AS longest_streak
+                FROM runs
+                ORDER BY user_id, last_date DESC
+            )
+            UPDATE user_totals t SET
+                current_streak = COALESCE(s.current_streak, 0),
+                longest_streak = COALESCE(s.longest_streak, 0),
+                last_active_date = s.last_date
+            FROM unnest(p_user_ids) AS ids(user_id)
+            LEFT JOIN streaks s ON s.user_id = ids.user_id
+            WHERE t.user_id = ids.user_id
+              AND (t.current_streak, t.longest_streak, t.last_active_date)
+                  IS DISTINCT FROM (COALESCE(s.current_streak, 0), COALESCE(s.longest_streak, 0), s.last_date);
+            
+            GET DIAGNOSTICS v_changed = ROW_COUNT;
+            RETURN v_changed;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # Триггеры уровня оператора: вставка нескольких строк одним INSERT
+    # или удаление нескольких строк одним DELETE применяется одним UPDATE.
+    # Сначала меняются суммы дня в pullups_daily, затем по ним - user_totals.
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION user_totals_after_pullups_insert() RETURNS trigger AS $$
+        DECLARE
+            v_recompute BIGINT[];
+        BEGIN
+            INSERT INTO user_totals (user_id)
+            SELECT DISTINCT user_id FROM new_rows
+            ON CONFLICT (user_id) DO NOTHING;
+            
+            -- Блокируем строки итогов до подсчета дней, чтобы параллельные
+            -- записи одного пользователя применялись по очереди
+            PERFORM 1 FROM user_totals
+            WHERE user_id IN (SELECT user_id FROM new_rows)
+            ORDER BY user_id
+            FOR UPDATE;
+            
+            -- Все подзапросы видят pullups_daily до вставки, поэтому новый день -
+            -- тот, которого там еще нет, а новая сумма дня возвращается из RETURNING
+            WITH days AS (
+                SELECT
+                    n.user_id,
+                    n.date,
+                    SUM(n.count) AS day_total,
+                    COUNT(*) AS records,
+                    NOT EXISTS (
+                        SELECT 1 FROM pullups_daily d
+                        WHERE d.user_id = n.user_id AND d.date = n.date
+                    ) AS is_new_day
+                FROM new_rows n
+                GROUP BY n.user_id, n.date
+            ),
+            rolled AS (
+                INSERT INTO pullups_daily AS d (user_id, date, total, entries)
+                SELECT user_id, date, day_total, records FROM days
+                ON CONFLICT (user_id, date) DO UPDATE SET
+                    total = d.total + EXCLUDED.total,
+                    entries = d.entries + EXCLUDED.entries
+                RETURNING d.user_id, d.date, d.total
+            ),
+            added AS (
+                SELECT DISTINCT ON (user_id)
+                    user_id,
+                    date AS max_date,
+                    SUM(day_total) OVER w AS total,
+                    SUM(records) OVER w AS records,
+                    COUNT(*) FILTER (WHERE is_new_day) OVER w AS new_days,
+                    MAX(date) FILTER (WHERE is_new_day) OVER w AS last_new_day
+                FROM days
+                WINDOW w AS (PARTITION BY user_id)
+                ORDER BY user_id, date DESC
+            ),
+            last AS (
+                SELECT DISTINCT ON (user_id) user_id, id, created_at
+                FROM new_rows
+                ORDER BY user_id, created_at DESC, id DESC
+            ),
+            -- Серия за O(1): новый день сразу после последнего активного продлевает ее,
+            -- новый день после перерыва начинает новую. Дни задним числом и несколько
+            -- новых дней в одном операторе пересчитываются по pullups_daily ниже
+            streaks AS (
+                SELECT
+                    a.user_id,
+                    CASE
+                        WHEN a.new_days = 1
+                            AND (s.last_active_date IS NULL OR a.last_new_day > s.last_active_date)
+                        THEN CASE
+                            WHEN a.last_new_day = s.last_active_date + 1 THEN s.current_streak + 1
+                            ELSE 1
+                        END
+                    END AS current_streak,
+                    a.new_days > 1 OR (a.new_days = 1 AND a.last_new_day < s.last_active_date) AS recompute
+                FROM added a
+                JOIN user_totals s ON s.user_id = a.user_id
+            ),
+            updated AS (
+                UPDATE user_totals t SET
+                    total = t.total + a.total,
+                    records_count = t.records_count + a.records,
+                    days_count = t.days_count + a.new_days,
+                    today_total = CASE
+                        WHEN t.today_date IS NULL OR a.max_date >= t.today_date THEN r.total
+                        ELSE t.today_total
+                    END,
+                    today_date = GREATEST(t.today_date, a.max_date),
+                    last_pullup_id = CASE
+                        WHEN t.last_created_at IS NULL OR l.created_at >= t.last_created_at THEN l.id
+                        ELSE t.last_pullup_id
+                    END,
+                    last_created_at = GREATEST(t.last_created_at, l.created_at),
+                    current_streak = COALESCE(s.current_streak, t.current_streak),
+                    longest_streak = GREATEST(t.longest_streak, s.current_streak),
+                    last_active_date = CASE
+                        WHEN s.current_streak IS NULL THEN t.last_active_date
+                        ELSE a.last_new_day
+                    END
+                FROM added a
+                JOIN rolled r ON r.user_id = a.user_id AND r.date = a.max_date
+                JOIN last l ON l.user_id = a.user_id
+                JOIN streaks s ON s.user_id = a.user_id
+                WHERE t.user_id = a.user_id
+                RETURNING t.user_id, s.recompute
+            )
+            SELECT array_agg(user_id) FILTER (WHERE recompute) INTO v_recompute FROM updated;
+            
+            IF v_recompute IS NOT NULL THEN
+                PERFORM recompute_user_streaks(v_recompute);
+            END IF;
+            
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    # При уплотнении (compact_pullups) удаляемые записи уже учтены в pullups_daily,
+    # поэтому триггер пропускает такие удаления по флагу сессии pullups.compacting
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION user_totals_after_pullups_delete() RETURNS trigger AS $$
+        DECLARE
+            v_emptied BIGINT[];
+        BEGIN
+            IF current_setting('pullups.compacting', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            
+            PERFORM 1 FROM user_totals
+            WHERE user_id IN (SELECT user_id FROM old_rows)
+            ORDER BY user_id
+            FOR UPDATE;
+            
+            -- Опустевшие дни удаляются, остальные уменьшаются
+            WITH days AS (
+                SELECT user_id, date, SUM(count) AS day_total, COUNT(*) AS records
+                FROM old_rows
+                GROUP BY user_id, date
+            ),
+            emptied AS (
+                DELETE FROM pullups_daily d
+                USING days x
+                WHERE d.user_id = x.user_id AND d.date = x.date AND d.entries <= x.records
+                RETURNING d.user_id
+            ),
+            shrunk AS (
+                UPDATE pullups_daily d SET
+                    total = d.total - x.day_total,
+                    entries = d.entries - x.records
+                FROM days x
+                WHERE d.user_id = x.user_id AND d.date = x.date AND d.entries > x.records
+            )
+            SELECT array_agg(DISTINCT user_id) INTO v_emptied FROM emptied;
+            
+            -- Последний день берется из pullups_daily, последняя запись - из pullups,
+            -- оба по индексу и только для затронутых пользователей
+            WITH removed AS (
+                SELECT
+                    o.user_id,
+                    SUM(o.count) AS total,
+                    COUNT(*) AS records,
+                    COUNT(DISTINCT o.date) FILTER (WHERE NOT EXISTS (
+                        SELECT 1 FROM pullups_daily d
+                        WHERE d.user_id = o.user_id AND d.date = o.date
+                    )) AS gone_days
+                FROM old_rows o
+                GROUP BY o.user_id
+            )
+            UPDATE user_totals t SET
+                total = t.total - r.total,
+                records_count = t.records_count - r.records,
+                days_count = t.days_count - r.gone_days,
+                today_date = d.date,
+                today_total = COALESCE(d.total, 0),
+                last_pullup_id = l.id,
+                last_created_at = l.created_at
+            FROM removed r
+            LEFT JOIN LATERAL (
+                SELECT date, total
+                FROM pullups_daily
+                WHERE user_id = r.user_id
+                ORDER BY date DESC
+                LIMIT 1
+            ) d ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT p.id, p.created_at
+                FROM pullups p
+                WHERE p.user_id = r.user_id
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT 1
+            ) l ON TRUE
+            WHERE t.user_id = r.user_id;
+            
+            -- Опустевший день мог разорвать серию: она пересчитывается по pullups_daily
+            IF v_emptied IS NOT NULL THEN
+                PERFORM recompute_user_streaks(v_emptied);
+            END IF;
+            
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def _migrate_streaks(cur):
+    """Миграция 7: серии дней подряд в user_totals и их заполнение по pullups_daily"""
+    # Блокировки берутся в том же порядке, что и у записи (users, затем pullups и
+    # сводные таблицы): пока триггеры и столбцы меняются, запись ждет, а не
+    # взаимоблокируется с миграцией
+    cur.execute("LOCK TABLE users, pullups IN SHARE ROW EXCLUSIVE MODE")
+    _init_streaks(cur)
+    cur.execute("SELECT recompute_user_streaks(NULL)")
+    logger.info(f"Серии заполнены у {cur.fetchone()[0]} пользователей")
+
+
+def _migrate_leaderboard_index(cur):
+    """Миграция 8: индекс порядка рейтинга для постраничного лидерборда"""
+    _create_index_concurrently(cur, 'idx_user_totals_rank', 'user_totals', "(total DESC, user_id)")
+
+
+def _migrate_chat_members(cur):
+    """Миграция 9: участники групповых чатов с копией суммы для рейтингов по чату"""
+    # Без внешнего ключа на users: участника видно в чате раньше, чем он
+    # запустит бота. total - копия user_totals.total (NULL, пока итогов нет):
+    # топ и место в чате читаются по индексу чата, без соединения с user_totals
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            total INTEGER,
+            joined_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_members_rank
+        ON chat_members (chat_id, total DESC, user_id) WHERE total IS NOT NULL
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members (user_id)")
+    
+    # Пользователь состоит в немногих чатах, поэтому копия обновляется одним
+    # UPDATE по idx_chat_members_user в транзакции записи
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION chat_members_sync_total() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE chat_members SET total = NULL WHERE user_id = OLD.user_id;
+            ELSIF TG_OP = 'INSERT' OR OLD.total IS DISTINCT FROM NEW.total THEN
+                UPDATE chat_members SET total = NEW.total WHERE user_id = NEW.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+        CREATE OR REPLACE TRIGGER trg_user_totals_chat_members
+            AFTER INSERT OR DELETE OR UPDATE OF total ON user_totals
+            FOR EACH ROW EXECUTE FUNCTION chat_members_sync_total()
+    """)
+    cur.execute("""
+        UPDATE chat_members m SET total = t.total
+        FROM user_totals t
+        WHERE t.user_id = m.user_id AND m.total IS DISTINCT FROM t.total
+    """)
+
+
+def _init_change_xids(cur):
+    """Миграция 10: номер транзакции в уведомлениях об изменениях.
+
+    К событию миграции 6 добавляется "x" - pg_current_xact_id() записавшей
+    транзакции: слушатель пропускает события, уже вошедшие в снимок, по
+    которому он сверил кэши после подключения.
+    """
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION pullups_notify_changes() RETURNS trigger AS $$
+        BEGIN
+            -- Уплотнение не меняет суммы
+            IF TG_OP = 'DELETE' AND current_setting('pullups.compacting', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            
+            IF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'u', user_id, 'd', SUM(count),
+                    'o', current_setting('application_name'),
+                    't', extract(epoch FROM clock_timestamp()),
+                    'x', pg_current_xact_id()::text
+                )::text)
+                FROM new_rows
+                GROUP BY user_id;
+            ELSE
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'u', user_id, 'd', -SUM(count),
+                    'o', current_setting('application_name'),
+                    't', extract(epoch FROM clock_timestamp()),
+                    'x', pg_current_xact_id()::text
+                )::text)
+                FROM old_rows
+                GROUP BY user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION users_notify_insert() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                'u', NEW.user_id, 'd', 0,
+                'o', current_setting('application_name'),
+                't', extract(epoch FROM clock_timestamp()),
+                'x', pg_current_xact_id()::text
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def _migrate_chat_members_bigint(cur):
+    """Миграция 11: chat_members.total - BIGINT, как копируемый user_totals.total"""
+    # Сумма больше INTEGER не помещалась в копию, и ошибка в триггере откатывала
+    # запись подтягиваний. Для уже BIGINT столбца ALTER ничего не переписывает
+    cur.execute("ALTER TABLE chat_members ALTER COLUMN total TYPE BIGINT")
+
+
+# Миграции схемы по порядку: (версия, название, функция, в транзакции ли).
+# Шаги идемпотентны: базы, созданные до появления schema_version, проходят их
+# все и ничего не теряют. Изменения схемы добавляются новым шагом в конец.
+# Шаги с CONCURRENTLY выполняются вне транзакции; если такой шаг прервется,
+# он будет повторен целиком при следующем запуске.
+MIGRATIONS = [
+    (1, 'base_tables', _migrate_base_tables, True),
+    (2, 'indexes', _migrate_indexes, False),
+    (3, 'summary_tables', _init_user_totals, True),
+    (4, 'write_functions', _init_write_functions, True),
+    (5, 'job_runs', _migrate_job_runs, True),
+    (6, 'change_notifications', _init_change_notifications, True),
+    (7, 'streaks', _migrate_streaks, True),
+    (8, 'leaderboard_index', _migrate_leaderboard_index, False),
+    (9, 'chat_members', _migrate_chat_members, True),
+    (10, 'change_xids', _init_change_xids, True),
+    (11, 'chat_members_bigint', _migrate_chat_members_bigint, True),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _rebuild_user_totals(cur, apply=True):
+    """Пересчитывает pullups_daily и итоги из pullups и уже уплотненных сумм;
+    возвращает пользователей, у которых итоги разошлись"""
+    # Сумма дня = оставшиеся записи pullups + то, что из них уже уплотнено
+    cur.execute("""
+        CREATE TEMP TABLE expected_daily ON COMMIT DROP AS
+        SELECT
+            COALESCE(r.user_id, d.user_id) AS user_id,
+            COALESCE(r.date, d.date) AS date,
+            COALESCE(r.total, 0) + COALESCE(d.compacted_total, 0) AS total,
+            COALESCE(r.entries, 0) + COALESCE(d.compacted_entries, 0) AS entries,
+            COALESCE(d.compacted_total, 0) AS compacted_total,
+            COALESCE(d.compacted_entries, 0) AS compacted_entries
+        FROM (
+            SELECT user_id, date, SUM(count) AS total, COUNT(*) AS entries
+            FROM pullups
+            GROUP BY user_id, date
+        ) r
+        FULL JOIN pullups_daily d ON d.user_id = r.user_id AND d.date = r.date
+        WHERE COALESCE(r.entries, 0) + COALESCE(d.compacted_entries, 0) > 0
+    """)
+    
+    cur.execute("""
+        SELECT COUNT(*) AS days
+        FROM expected_daily e
+        FULL JOIN pullups_daily d ON d.user_id = e.user_id AND d.date = e.date
+        WHERE (d.total, d.entries) IS DISTINCT FROM (e.total, e.entries)
+    """)
+    row = cur.fetchone()
+    daily_drift = row['days'] if isinstance(row, dict) else row[0]
+    if daily_drift:
+        logger.warning(f"pullups_daily: расходятся суммы за {daily_drift} дней")
+    
+    # Последняя запись (время) у полностью уплотненных пользователей известна только из user_totals
+    cur.execute("""
+        CREATE TEMP TABLE expected_totals ON COMMIT DROP AS
+        SELECT
+            u.user_id,
+            COALESCE(a.total, 0) AS total,
+            COALESCE(a.records_count, 0) AS records_count,
+            COALESCE(a.days_count, 0) AS days_count,
+            d.date AS today_date,
+            COALESCE(d.total, 0) AS today_total,
+            l.id AS last_pullup_id,
+            COALESCE(l.created_at, t.last_created_at) AS last_created_at
+        FROM users u
+        LEFT JOIN user_totals t ON t.user_id = u.user_id
+        LEFT JOIN (
+            SELECT user_id, SUM(total) AS total, SUM(entries) AS records_count,
+                   COUNT(*) AS days_count
+            FROM expected_daily
+            GROUP BY user_id
+        ) a ON a.user_id = u.user_id
+        LEFT JOIN (
+            SELECT DISTINCT ON (user_id) user_id, date, total
+            FROM expected_daily
+            ORDER BY user_id, date DESC
+        ) d ON d.user_id = u.user_id
+        LEFT JOIN (
+            SELECT DISTINCT ON (user_id) user_id, id, created_at
+            FROM pullups
+            ORDER BY user_id, created_at DESC, id DESC
+        ) l ON l.user_id = u.user_id
+    """)
+    
+    cur.execute("""
+        SELECT
+            e.user_id,
+            t.total AS actual_total, e.total AS expected_total,
+            t.records_count AS actual_records, e.records_count AS expected_records,
+            t.days_count AS actual_days, e.days_count AS expected_days,
+            t.today_total AS actual_today, e.today_total AS expected_today
+        FROM expected_totals e
+        LEFT JOIN user_totals t ON t.user_id = e.user_id
+        WHERE (t.total, t.records_count, t.days_count, t.today_date, t.today_total, t.last_pullup_id)
+            IS DISTINCT FROM
+            (e.total, e.records_count, e.days_count, e.today_date, e.today_total, e.last_pullup_id)
+        ORDER BY e.user_id
+    """)
+    drift = cur.fetchall()
+    
+    if apply:
+        cur.execute("DELETE FROM pullups_daily")
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_pullups_user_id ON pullups(user_id)
+            INSERT INTO pullups_daily (user_id, date, total, entries, compacted_total, compacted_entries)
+            SELECT user_id, date, total, entries, compacted_total, compacted_entries
+            FROM expected_daily
         """)
+        cur.execute("DELETE FROM user_totals")
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_pullups_date ON pullups(date)
+            INSERT INTO user_totals (
+                user_id, total, records_count, days_count,
+                today_date, today_total, last_pullup_id, last_created_at
+            )
+            SELECT
+                user_id, total, records_count, days_count,
+                today_date, today_total, last_pullup_id, last_created_at
+            FROM expected_totals
         """)
+        # При заполнении в миграции 3 серий еще нет, их заполнит миграция 7
+        cur.execute("SELECT to_regprocedure('recompute_user_streaks(bigint[])') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT recompute_user_streaks(NULL)")
+    
+    cur.execute("DROP TABLE expected_totals")
+    cur.execute("DROP TABLE expected_daily")
+    return drift
+
+
+@metrics.track_query
+def rebuild_user_totals(apply=True):
+    """Сверяет pullups_daily и user_totals с pullups и (если apply) перестраивает их; возвращает расхождения"""
+    conn = get_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        # Запись в pullups на время пересчета блокируется, чтение - нет
+        cur.execute("LOCK TABLE pullups IN SHARE MODE")
+        drift = _rebuild_user_totals(cur, apply=apply)
+        if apply:
+            conn.commit()
+        else:
+            conn.rollback()
+        return drift
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете итогов пользователей: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def rebuild_streaks():
+    """Пересчитывает серии всех пользователей по pullups_daily; возвращает число исправленных"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Запись на время пересчета блокируется, иначе ее изменение серии затрется
+        cur.execute("LOCK TABLE pullups IN SHARE MODE")
+        cur.execute("SELECT recompute_user_streaks(NULL)")
+        changed = cur.fetchone()[0]
+        conn.commit()
+        return changed
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете серий: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def ensure_pullups_partitions():
+    """Создает партиции pullups на PULLUPS_PARTITIONS_AHEAD месяцев вперед"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        kind = _get_pullups_kind(cur)
+        if kind != 'p':
+            if kind == 'r' and PULLUPS_PARTITIONED:
+                logger.warning(
+                    "PULLUPS_PARTITIONED включен, но таблица pullups уже создана обычной: "
+                    "перенесите данные командой python maintenance.py partition-pullups"
+                )
+            conn.rollback()
+            return False
+        today = date.today()
+        _create_pullups_partitions(cur, 'pullups', today, _add_months(today, PULLUPS_PARTITIONS_AHEAD))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при создании партиций pullups: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def partition_pullups_table():
+    """Переносит обычную таблицу pullups в секционированную по месяцам.
+
+    Выполняется в одной транзакции под эксклюзивной блокировкой pullups:
+    на время переноса запись и чтение записей ждут. id и последовательность
+    сохраняются, поэтому user_totals и pullups_daily остаются верными.
+    Возвращает число перенесенных записей или None, если таблица уже секционирована.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        if _get_pullups_kind(cur) != 'r':
+            conn.rollback()
+            return None
+        
+        # users блокируется первой, как при записи, чтобы не взаимоблокироваться с ней
+        cur.execute("LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("LOCK TABLE pullups IN ACCESS EXCLUSIVE MODE")
+        cur.execute("SELECT pg_get_serial_sequence('pullups', 'id')")
+        sequence = cur.fetchone()[0]
+        cur.execute("SELECT MIN(date), MAX(date) FROM pullups")
+        first_day, last_day = cur.fetchone()
+        today = date.today()
+        
+        _create_partitioned_pullups(cur, 'pullups_partitioned', sequence)
+        _create_pullups_partitions(
+            cur, 'pullups_partitioned',
+            min(filter(None, (first_day, CHALLENGE_START_DATE, today))),
+            max(filter(None, (last_day, _add_months(today, PULLUPS_PARTITIONS_AHEAD))))
+        )
+        # Триггеры итогов висят на старой таблице, поэтому копирование их не трогает
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_pullups_user_date ON pullups(user_id, date)
+            INSERT INTO pullups_partitioned (id, user_id, count, created_at, date)
+            SELECT id, user_id, count, created_at, COALESCE(date, created_at::date, CURRENT_DATE)
+            FROM pullups
         """)
+        moved = cur.rowcount
         
+        # Последовательность переходит к новой таблице, а не удаляется вместе со старой
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        cur.execute("DROP TABLE pullups")
+        cur.execute("ALTER TABLE pullups_partitioned RENAME TO pullups")
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY pullups.id")
+        
+        _init_pullups_indexes(cur, partitioned=True)
+        _init_user_totals(cur)
+        _init_streaks(cur)
+        _init_change_notifications(cur)
+        _init_change_xids(cur)
         conn.commit()
-        logger.info("База данных инициализирована успешно")
+        logger.info(f"Таблица pullups секционирована по месяцам, перенесено записей: {moved}")
+        return moved
+    except Exception as e:
+        logger.error(f"Ошибка при секционировании pullups: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+# Сколько записей pullups уплотняется в одной транзакции
+COMPACT_BATCH_SIZE = 5000
+
+
+@metrics.track_query
+def compact_pullups(before_date, batch_size=COMPACT_BATCH_SIZE):
+    """Удаляет записи pullups раньше before_date, оставляя их суммы в pullups_daily.
+
+    Работает короткими транзакциями по batch_size записей; возвращает число удаленных.
+    Отменить уплотненные записи через /undo уже нельзя.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    removed = 0
+    
+    try:
+        while True:
+            # Триггер удаления пропускает эти строки: их суммы уже в pullups_daily и user_totals
+            cur.execute("SET LOCAL pullups.compacting = 'on'")
+            cur.execute("""
+                SELECT id, user_id FROM pullups
+                WHERE date < %s
+                ORDER BY id
+                LIMIT %s
+            """, (before_date, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+            
+            # Итоги блокируются в том же порядке, что и в триггерах и при отмене
+            cur.execute("""
+                SELECT 1 FROM user_totals
+                WHERE user_id = ANY(%s)
+                ORDER BY user_id
+                FOR UPDATE
+            """, (list({user_id for _, user_id in rows}),))
+            
+            cur.execute("""
+                WITH deleted AS (
+                    DELETE FROM pullups
+                    WHERE id = ANY(%s)
+                    RETURNING id, user_id, date, count
+                ),
+                compacted AS (
+                    UPDATE pullups_daily d SET
+                        compacted_total = d.compacted_total + x.total,
+                        compacted_entries = d.compacted_entries + x.entries
+                    FROM (
+                        SELECT user_id, date, SUM(count) AS total, COUNT(*) AS entries
+                        FROM deleted
+                        GROUP BY user_id, date
+                    ) x
+                    WHERE d.user_id = x.user_id AND d.date = x.date
+                ),
+                unlinked AS (
+                    UPDATE user_totals t SET last_pullup_id = NULL
+                    FROM deleted
+                    WHERE t.last_pullup_id = deleted.id
+                )
+                SELECT COUNT(*) FROM deleted
+            """, ([pullup_id for pullup_id, _ in rows],))
+            removed += cur.fetchone()[0]
+            conn.commit()
+            
+            if len(rows) < batch_size:
+                break
+        
+        if removed:
+            logger.info(f"Уплотнено записей pullups раньше {before_date}: {removed}")
+        return removed
+    except Exception as e:
+        logger.error(f"Ошибка при уплотнении записей: {e}")
+        conn.rollback()
+        return removed
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def add_user(user_id, username=None, first_name=None, last_name=None):
+    """Добавляет пользователя в базу данных"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id) 
+            DO UPDATE SET 
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                is_active = TRUE
+            WHERE (users.username, users.first_name, users.last_name, users.is_active)
+                IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, TRUE)
+        """, (user_id, username, first_name, last_name))
+        conn.commit()
+        _notify_write(user_id, 0)
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении пользователя: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def add_pullups(user_id, count, pullup_date=None):
+    """Добавляет подтягивания пользователю"""
+    if pullup_date is None:
+        pullup_date = date.today()
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            INSERT INTO pullups (user_id, count, date)
+            VALUES (%s, %s, %s)
+        """, (user_id, count, pullup_date))
+        conn.commit()
+        _notify_write(user_id, count)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении подтягиваний: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def add_pullups_and_summarize(user_id, count, username=None, first_name=None, last_name=None,
+                              pullup_date=None):
+    """Добавляет подтягивания и возвращает {'today', 'total'} за один запрос к БД.
+
+    count - число или список чисел (несколько записей одной вставкой).
+    Пользователь создается, если его еще нет, поэтому отдельный add_user не нужен.
+    Возвращает None при ошибке.
+    """
+    if pullup_date is None:
+        pullup_date = date.today()
+    counts = [count] if isinstance(count, int) else list(count)
+    
+    conn = get_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        # Один оператор в autocommit - одна транзакция и один round-trip без BEGIN/COMMIT
+        conn.autocommit = True
+        cur.execute("""
+            SELECT today, total
+            FROM add_pullups_summary(%s, %s::INTEGER[], %s, %s, %s, %s)
+        """, (user_id, counts, pullup_date, username, first_name, last_name))
+        summary = cur.fetchone()
+        _notify_write(user_id, sum(counts))
+        return {'today': summary['today'], 'total': summary['total']}
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении подтягиваний: {e}")
+        return None
+    finally:
+        conn.autocommit = False
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_user_total(user_id):
+    """Возвращает общее количество подтягиваний пользователя"""
+    conn = get_read_connection(user_id)
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            SELECT total
+            FROM user_totals
+            WHERE user_id = %s
+        """, (user_id,))
+        result = cur.fetchone()
+        return result[0] if result else 0
+    except Exception as e:
+        logger.error(f"Ошибка при получении общего количества: {e}")
+        return 0
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def _build_stats(total, days_count, records_count, current_streak=0, longest_streak=0,
+                 last_active_date=None):
+    """Собирает словарь статистики из итогов пользователя"""
+    # Среднее в день
+    today = date.today()
+    days_passed = max(1, (today - CHALLENGE_START_DATE).days + 1)
+    avg_per_day = total / days_passed if days_passed > 0 else 0
+    
+    # Процент выполнения цели
+    progress_percent = (total / CHALLENGE_TARGET * 100) if CHALLENGE_TARGET > 0 else 0
+    
+    # Серия жива, пока последний активный день - сегодня или вчера
+    if last_active_date is None or (today - last_active_date).days > 1:
+        current_streak = 0
+    
+    return {
+        'total': total,
+        'days_count': days_count,
+        'avg_per_day': round(avg_per_day, 2),
+        'progress_percent': round(progress_percent, 2),
+        'records_count': records_count,
+        'current_streak': current_streak,
+        'longest_streak': longest_streak
+    }
+
+
+def _empty_stats():
+    return {
+        'total': 0,
+        'days_count': 0,
+        'avg_per_day': 0,
+        'progress_percent': 0,
+        'records_count': 0,
+        'current_streak': 0,
+        'longest_streak': 0
+    }
+
+
+@metrics.track_query
+def get_user_stats(user_id):
+    """Возвращает статистику пользователя"""
+    conn = get_read_connection(user_id)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        # Общее количество, дни с записями, количество записей и серии одним запросом
+        cur.execute("""
+            SELECT total, days_count, records_count, current_streak, longest_streak, last_active_date
+            FROM user_totals
+            WHERE user_id = %s
+        """, (user_id,))
+        row = cur.fetchone()
+        if row is None:
+            return _build_stats(0, 0, 0)
+        return _build_stats(**row)
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики: {e}")
+        return _empty_stats()
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+# Сколько пользователей запрашивать за один запрос в get_stats_for_users
+STATS_BATCH_SIZE = 1000
+
+
+@metrics.track_query
+def get_stats_for_users(user_ids):
+    """Возвращает {user_id: статистика} для многих пользователей пачками по STATS_BATCH_SIZE"""
+    user_ids = list(user_ids)
+    result = {}
+    if not user_ids:
+        return result
+    
+    conn = get_read_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        for i in range(0, len(user_ids), STATS_BATCH_SIZE):
+            cur.execute("""
+                SELECT
+                    ids.user_id,
+                    COALESCE(t.total, 0) as total,
+                    COALESCE(t.days_count, 0) as days_count,
+                    COALESCE(t.records_count, 0) as records_count,
+                    COALESCE(t.current_streak, 0) as current_streak,
+                    COALESCE(t.longest_streak, 0) as longest_streak,
+                    t.last_active_date
+                FROM unnest(%s::bigint[]) AS ids(user_id)
+                LEFT JOIN user_totals t ON t.user_id = ids.user_id
+            """, (user_ids[i:i + STATS_BATCH_SIZE],))
+            for row in cur.fetchall():
+                user_id = row.pop('user_id')
+                result[user_id] = _build_stats(**row)
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики пользователей: {e}")
+        return {user_id: result.get(user_id, _empty_stats()) for user_id in user_ids}
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_leaderboard(limit=20):
+    """Возвращает топ пользователей"""
+    conn = get_read_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        cur.execute("""
+            SELECT 
+                u.user_id,
+                u.username,
+                u.first_name,
+                t.total
+            FROM user_totals t
+            JOIN users u ON u.user_id = t.user_id
+            ORDER BY t.total DESC, t.user_id
+            LIMIT %s
+        """, (limit,))
+        return cur.fetchall()
     except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {e}")
-        conn.rollback()
-        raise
+        logger.error(f"Ошибка при получении лидерборда: {e}")
+        return []
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def add_user(user_id, username=None, first_name=None, last_name=None):
-    """Добавляет пользователя в базу данных"""
-    conn = get_connection()
-    cur = conn.cursor()
+# Порядок рейтинга - total DESC, user_id ASC. Направления разные, поэтому ключ
+# (total, user_id) не сравнивается одним сравнением строк; строки после и перед
+# ключом выбираются двумя диапазонами idx_user_totals_rank, каждый не длиннее страницы
+_LEADERBOARD_AFTER = """
+    (SELECT total, user_id FROM user_totals
+     WHERE total = %(total)s AND user_id > %(user_id)s
+     ORDER BY user_id LIMIT %(limit)s)
+    UNION ALL
+    (SELECT total, user_id FROM user_totals
+     WHERE total < %(total)s
+     ORDER BY total DESC, user_id LIMIT %(limit)s)
+"""
+_LEADERBOARD_BEFORE = """
+    (SELECT total, user_id FROM user_totals
+     WHERE total = %(total)s AND user_id < %(user_id)s
+     ORDER BY user_id DESC LIMIT %(limit)s)
+    UNION ALL
+    (SELECT total, user_id FROM user_totals
+     WHERE total > %(total)s
+     ORDER BY total, user_id DESC LIMIT %(limit)s)
+"""
+
+
+def _fetch_leaderboard_page(cur, after=None, before=None, limit=20):
+    """Строки рейтинга после ключа after, перед ключом before или с начала"""
+    if after is not None:
+        keys, order, key = _LEADERBOARD_AFTER, "total DESC, user_id", after
+    elif before is not None:
+        keys, order, key = _LEADERBOARD_BEFORE, "total, user_id DESC", before
+    else:
+        keys = "SELECT total, user_id FROM user_totals ORDER BY total DESC, user_id LIMIT %(limit)s"
+        order, key = "total DESC, user_id", (None, None)
+    cur.execute(f"""
+        SELECT u.user_id, u.username, u.first_name, k.total
+        FROM (SELECT * FROM ({keys}) keys ORDER BY {order} LIMIT %(limit)s) k
+        JOIN users u ON u.user_id = k.user_id
+        ORDER BY k.total DESC, k.user_id
+    """, {'total': key[0], 'user_id': key[1], 'limit': limit})
+    return cur.fetchall()
+
+
+@metrics.track_query
+def get_leaderboard_page(after=None, before=None, limit=20):
+    """Страница рейтинга по ключу (total, user_id): следующая после after,
+    предыдущая перед before или первая. Страница N стоит столько же, сколько первая"""
+    conn = get_read_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        cur.execute("""
-            INSERT INTO users (user_id, username, first_name, last_name)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET 
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name
-        """, (user_id, username, first_name, last_name))
-        conn.commit()
+        return _fetch_leaderboard_page(cur, after, before, limit)
     except Exception as e:
-        logger.error(f"Ошибка при добавлении пользователя: {e}")
-        conn.rollback()
-        raise
+        logger.error(f"Ошибка при получении страницы лидерборда: {e}")
+        return []
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def add_pullups(user_id, count, pullup_date=None):
-    """Добавляет подтягивания пользователю"""
-    if pullup_date is None:
-        pullup_date = date.today()
+@metrics.track_query
+def get_leaderboard_around(user_id, above=5, below=5):
+    """Пользователь и его соседи по рейтингу: до above строк выше и до below ниже"""
+    conn = get_read_connection(user_id)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
     
+    try:
+        cur.execute("""
+            SELECT u.user_id, u.username, u.first_name, t.total
+            FROM user_totals t
+            JOIN users u ON u.user_id = t.user_id
+            WHERE t.user_id = %s
+        """, (user_id,))
+        me = cur.fetchone()
+        if me is None:
+            return []
+        key = (me['total'], user_id)
+        return (
+            _fetch_leaderboard_page(cur, before=key, limit=above)
+            + [me]
+            + _fetch_leaderboard_page(cur, after=key, limit=below)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при получении соседей по рейтингу: {e}")
+        return []
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def add_chat_members(chat_id, user_ids):
+    """Отмечает пользователей участниками группового чата"""
     conn = get_connection()
     cur = conn.cursor()
     
     try:
+        # FOR SHARE ждет параллельную запись итогов пользователя, иначе ее
+        # триггер не увидит еще не вставленную строку и копия суммы устареет
         cur.execute("""
-            INSERT INTO pullups (user_id, count, date)
-            VALUES (%s, %s, %s)
-        """, (user_id, count, pullup_date))
+            INSERT INTO chat_members (chat_id, user_id, total)
+            SELECT %s, ids.user_id, t.total
+            FROM unnest(%s::bigint[]) AS ids(user_id)
+            LEFT JOIN LATERAL (
+                SELECT total FROM user_totals WHERE user_id = ids.user_id FOR SHARE
+            ) t ON TRUE
+            ON CONFLICT DO NOTHING
+        """, (chat_id, list(user_ids)))
         conn.commit()
+        for user_id in user_ids:
+            _mark_written(user_id)
         return True
     except Exception as e:
-        logger.error(f"Ошибка при добавлении подтягиваний: {e}")
+        logger.error(f"Ошибка при добавлении участников чата {chat_id}: {e}")
         conn.rollback()
         return False
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def get_user_total(user_id):
-    """Возвращает общее количество подтягиваний пользователя"""
+@metrics.track_query
+def remove_chat_members(chat_id, user_ids=None):
+    """Удаляет участников группового чата; без user_ids - всех (бота удалили из чата)"""
     conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("""
-            SELECT COALESCE(SUM(count), 0) as total
-            FROM pullups
-            WHERE user_id = %s
-        """, (user_id,))
-        result = cur.fetchone()
-        return result[0] if result else 0
+        if user_ids is None:
+            cur.execute("DELETE FROM chat_members WHERE chat_id = %s", (chat_id,))
+        else:
+            cur.execute(
+                "DELETE FROM chat_members WHERE chat_id = %s AND user_id = ANY(%s)",
+                (chat_id, list(user_ids))
+            )
+        conn.commit()
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при получении общего количества: {e}")
-        return 0
+        logger.error(f"Ошибка при удалении участников чата {chat_id}: {e}")
+        conn.rollback()
+        return False
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def get_user_stats(user_id):
-    """Возвращает статистику пользователя"""
+@metrics.track_query
+def move_chat_members(old_chat_id, new_chat_id):
+    """Переносит участников на новый ID чата (группа стала супергруппой)"""
     conn = get_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor()
     
     try:
-        # Общее количество
-        cur.execute("""
-            SELECT COALESCE(SUM(count), 0) as total
-            FROM pullups
-            WHERE user_id = %s
-        """, (user_id,))
-        total = cur.fetchone()['total']
-        
-        # Количество дней с записями
         cur.execute("""
-            SELECT COUNT(DISTINCT date) as days_count
-            FROM pullups
-            WHERE user_id = %s
-        """, (user_id,))
-        days_count = cur.fetchone()['days_count']
-        
-        # Среднее в день
-        today = date.today()
-        days_passed = max(1, (today - CHALLENGE_START_DATE).days + 1)
-        avg_per_day = total / days_passed if days_passed > 0 else 0
-        
-        # Процент выполнения цели
-        progress_percent = (total / CHALLENGE_TARGET * 100) if CHALLENGE_TARGET > 0 else 0
-        
-        # Количество записей
-        cur.execute("""
-            SELECT COUNT(*) as records_count
-            FROM pullups
-            WHERE user_id = %s
-        """, (user_id,))
-        records_count = cur.fetchone()['records_count']
-        
-        return {
-            'total': total,
-            'days_count': days_count,
-            'avg_per_day': round(avg_per_day, 2),
-            'progress_percent': round(progress_percent, 2),
-            'records_count': records_count
-        }
+            WITH moved AS (
+                DELETE FROM chat_members WHERE chat_id = %s RETURNING user_id, total, joined_at
+            )
+            INSERT INTO chat_members (chat_id, user_id, total, joined_at)
+            SELECT %s, user_id, total, joined_at FROM moved
+            ON CONFLICT DO NOTHING
+        """, (old_chat_id, new_chat_id))
+        conn.commit()
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        return {
-            'total': 0,
-            'days_count': 0,
-            'avg_per_day': 0,
-            'progress_percent': 0,
-            'records_count': 0
-        }
+        logger.error(f"Ошибка при переносе участников чата {old_chat_id}: {e}")
+        conn.rollback()
+        return False
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def get_leaderboard(limit=20):
-    """Возвращает топ пользователей"""
-    conn = get_connection()
+@metrics.track_query
+def get_chat_leaderboard(chat_id, user_id=None, limit=20):
+    """Топ участников чата и строка пользователя user_id, с местом в чате (rank)
+    и числом участников рейтинга (members)"""
+    conn = get_read_connection(user_id)
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
+        # Все запросы идут по idx_chat_members_rank и читают только строки этого
+        # чата: не больше limit строк топа и участников выше пользователя
         cur.execute("""
-            SELECT 
-                u.user_id,
-                u.username,
-                u.first_name,
-                COALESCE(SUM(p.count), 0) as total
-            FROM users u
-            LEFT JOIN pullups p ON u.user_id = p.user_id
-            GROUP BY u.user_id, u.username, u.first_name
-            ORDER BY total DESC
+            SELECT m.user_id, u.username, u.first_name, m.total
+            FROM chat_members m
+            JOIN users u ON u.user_id = m.user_id
+            WHERE m.chat_id = %s AND m.total IS NOT NULL
+            ORDER BY m.total DESC, m.user_id
             LIMIT %s
-        """, (limit,))
-        return cur.fetchall()
+        """, (chat_id, limit))
+        rows = cur.fetchall()
+        if not rows:
+            return []
+        
+        cur.execute(
+            "SELECT COUNT(*) as members FROM chat_members WHERE chat_id = %s AND total IS NOT NULL",
+            (chat_id,)
+        )
+        members = cur.fetchone()['members']
+        for rank, row in enumerate(rows, 1):
+            row['rank'] = rank
+            row['members'] = members
+        
+        if user_id is not None and all(row['user_id'] != user_id for row in rows):
+            cur.execute("""
+                SELECT
+                    me.user_id, u.username, u.first_name, me.total,
+                    (SELECT COUNT(*) + 1 FROM chat_members m
+                     WHERE m.chat_id = me.chat_id AND m.total >= me.total
+                       AND (m.total > me.total OR m.user_id < me.user_id)) as rank,
+                    %s as members
+                FROM chat_members me
+                JOIN users u ON u.user_id = me.user_id
+                WHERE me.chat_id = %s AND me.user_id = %s AND me.total IS NOT NULL
+            """, (members, chat_id, user_id))
+            mine = cur.fetchone()
+            if mine:
+                rows.append(mine)
+        return rows
     except Exception as e:
-        logger.error(f"Ошибка при получении лидерборда: {e}")
+        logger.error(f"Ошибка при получении рейтинга чата {chat_id}: {e}")
         return []
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
+@metrics.track_query
 def get_user_rank(user_id):
     """Возвращает позицию пользователя в рейтинге"""
-    conn = get_connection()
+    conn = get_read_connection(user_id)
     cur = conn.cursor()
     
     try:
         cur.execute("""
-            WITH user_totals AS (
-                SELECT 
-                    u.user_id,
-                    COALESCE(SUM(p.count), 0) as total
-                FROM users u
-                LEFT JOIN pullups p ON u.user_id = p.user_id
-                GROUP BY u.user_id
-            ),
-            ranked_users AS (
-                SELECT 
-                    user_id,
-                    total,
-                    ROW_NUMBER() OVER (ORDER BY total DESC) as rank
-                FROM user_totals
-            )
-            SELECT rank
-            FROM ranked_users
-            WHERE user_id = %s
+            SELECT (
+                SELECT COUNT(*)
+                FROM user_totals t
+                WHERE t.total > me.total
+                   OR (t.total = me.total AND t.user_id < me.user_id)
+            ) + 1 as rank
+            FROM user_totals me
+            WHERE me.user_id = %s
         """, (user_id,))
         result = cur.fetchone()
         return result[0] if result else None
@@ -259,19 +2408,20 @@ def get_user_rank(user_id):
         return None
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
+@metrics.track_query
 def get_today_pullups(user_id):
     """Возвращает количество подтягиваний пользователя за сегодня"""
-    conn = get_connection()
+    conn = get_read_connection(user_id)
     cur = conn.cursor()
     
     try:
         cur.execute("""
-            SELECT COALESCE(SUM(count), 0) as total
-            FROM pullups
-            WHERE user_id = %s AND date = CURRENT_DATE
+            SELECT CASE WHEN today_date = CURRENT_DATE THEN today_total ELSE 0 END
+            FROM user_totals
+            WHERE user_id = %s
         """, (user_id,))
         result = cur.fetchone()
         return result[0] if result else 0
@@ -280,21 +2430,22 @@ def get_today_pullups(user_id):
         return 0
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
+@metrics.track_query
 def get_last_pullup(user_id):
     """Возвращает последнюю запись подтягиваний пользователя"""
+    # По ней удаляется запись, поэтому она всегда читается из основной БД
     conn = get_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
         cur.execute("""
-            SELECT id, count, date, created_at
-            FROM pullups
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-            LIMIT 1
+            SELECT p.id, p.count, p.date, p.created_at
+            FROM user_totals t
+            JOIN pullups p ON p.id = t.last_pullup_id
+            WHERE t.user_id = %s
         """, (user_id,))
         return cur.fetchone()
     except Exception as e:
@@ -302,39 +2453,318 @@ def get_last_pullup(user_id):
         return None
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
+@metrics.track_query
 def delete_pullup(pullup_id):
     """Удаляет запись подтягиваний по ID"""
     conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("DELETE FROM pullups WHERE id = %s", (pullup_id,))
+        cur.execute("DELETE FROM pullups WHERE id = %s RETURNING user_id, count", (pullup_id,))
+        deleted = cur.fetchone()
         conn.commit()
-        return cur.rowcount > 0
+        if deleted:
+            _notify_write(deleted[0], -deleted[1])
+        return deleted is not None
     except Exception as e:
         logger.error(f"Ошибка при удалении записи: {e}")
         conn.rollback()
         return False
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def get_all_users():
-    """Возвращает список всех пользователей для напоминаний"""
+@metrics.track_query
+def undo_last_pullups(user_id, steps=1):
+    """Отменяет последние steps записей и возвращает итоги за один запрос к БД.
+
+    Возвращает {'removed_count', 'removed_entries', 'today', 'total'} или None при ошибке.
+    """
     conn = get_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        conn.autocommit = True
+        cur.execute("""
+            SELECT removed_count, removed_entries, today, total
+            FROM undo_pullups_summary(%s, %s)
+        """, (user_id, steps))
+        summary = cur.fetchone()
+        if summary is None:
+            return {'removed_count': 0, 'removed_entries': 0, 'today': 0, 'total': 0}
+        if summary['removed_entries']:
+            _notify_write(user_id, -summary['removed_count'])
+        return dict(summary)
+    except Exception as e:
+        logger.error(f"Ошибка при отмене записей: {e}")
+        return None
+    finally:
+        conn.autocommit = False
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_all_users():
+    """Возвращает список активных пользователей для напоминаний"""
+    conn = get_read_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT user_id FROM users")
+        cur.execute("SELECT user_id FROM users WHERE is_active")
         return [row[0] for row in cur.fetchall()]
     except Exception as e:
         logger.error(f"Ошибка при получении списка пользователей: {e}")
         return []
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def deactivate_users(user_ids):
+    """Помечает неактивными пользователей, заблокировавших бота"""
+    if not user_ids:
+        return
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            "UPDATE users SET is_active = FALSE WHERE user_id = ANY(%s)",
+            (list(user_ids),)
+        )
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка при деактивации пользователей: {e}")
+        conn.rollback()
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_reminder_settings(user_id):
+    """Возвращает время напоминаний и часовой пояс пользователя"""
+    conn = get_read_connection(user_id)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        cur.execute("""
+            SELECT reminder_time, timezone
+            FROM users
+            WHERE user_id = %s
+        """, (user_id,))
+        return cur.fetchone()
+    except Exception as e:
+        logger.error(f"Ошибка при получении настроек напоминаний: {e}")
+        return None
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def set_reminder_settings(user_id, reminder_time, timezone=None):
+    """Сохраняет время напоминаний (None - по умолчанию) и часовой пояс (None - не менять)"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            UPDATE users
+            SET reminder_time = %s, timezone = COALESCE(%s, timezone)
+            WHERE user_id = %s
+        """, (reminder_time, timezone, user_id))
+        conn.commit()
+        _mark_written(user_id)
+        return cur.rowcount > 0
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении настроек напоминаний: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_reminder_timezones():
+    """Возвращает часовые пояса активных пользователей"""
+    conn = get_read_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT DISTINCT timezone FROM users WHERE is_active")
+        return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при получении часовых поясов: {e}")
+        return []
+    finally:
+        cur.close()
+        release_connection(conn)
+
 
+@metrics.track_query
+def get_due_reminder_users(slots, default_slots, spread, policy=None):
+    """Возвращает пользователей, чье время напоминания наступило.
+
+    slots - пары (часовой пояс, локальное время) для пользователей со своим временем,
+    default_slots - пары (часовой пояс, сдвиг) для пользователей со временем по умолчанию,
+    у которых user_id % spread равен сдвигу. policy - фильтры получателей:
+    not_logged_today, active_days (число дней или None), behind_plan.
+    """
+    if not slots and not default_slots:
+        return []
+    policy = policy or {}
+    
+    today = date.today()
+    days_passed = max(1, (today - CHALLENGE_START_DATE).days + 1)
+    
+    conn = get_read_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Один запрос: каждый слот - поиск по индексу idx_users_reminder_slot (свое время -
+        # по равенству reminder_time, время по умолчанию - по reminder_time IS NULL).
+        # Слоты соединяются с users, а не проверяются через OR двух IN: с OR планировщик
+        # не может искать по индексу и читает всех активных пользователей. "Сегодня еще
+        # не записал" - антиджойн по первичному ключу pullups_daily, остальные условия -
+        # по строке user_totals
+        cur.execute("""
+            WITH due AS (
+                SELECT u.user_id, u.created_at
+                FROM unnest(%(slot_tz)s::varchar[], %(slot_time)s::time[]) AS s(timezone, reminder_time)
+                JOIN users u ON u.timezone = s.timezone AND u.reminder_time = s.reminder_time
+                WHERE u.is_active
+                UNION ALL
+                SELECT u.user_id, u.created_at
+                FROM unnest(%(default_tz)s::varchar[], %(default_offset)s::bigint[]) AS s(timezone, shift)
+                JOIN users u ON u.timezone = s.timezone AND u.reminder_time IS NULL
+                WHERE u.is_active AND u.user_id %% %(spread)s = s.shift
+            )
+            SELECT u.user_id
+            FROM due u
+            LEFT JOIN user_totals t ON t.user_id = u.user_id
+            WHERE (NOT %(not_logged_today)s OR NOT EXISTS (
+                SELECT 1 FROM pullups_daily d
+                WHERE d.user_id = u.user_id AND d.date = CURRENT_DATE
+              ))
+              AND (%(active_days)s::int IS NULL OR GREATEST(t.last_created_at, u.created_at)
+                   >= CURRENT_TIMESTAMP - make_interval(days => %(active_days)s::int))
+              AND (NOT %(behind_plan)s OR COALESCE(t.total, 0) < %(plan_total)s)
+            ORDER BY u.user_id
+        """, {
+            'slot_tz': [tz for tz, _ in slots],
+            'slot_time': [t for _, t in slots],
+            'spread': max(1, spread),
+            'default_tz': [tz for tz, _ in default_slots],
+            'default_offset': [offset for _, offset in default_slots],
+            'not_logged_today': bool(policy.get('not_logged_today')),
+            'active_days': policy.get('active_days'),
+            'behind_plan': bool(policy.get('behind_plan')),
+            'plan_total': DAILY_PLAN * days_passed
+        })
+        return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при выборе пользователей для напоминаний: {e}")
+        return []
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_all_totals():
+    """Возвращает пары (user_id, total) всех пользователей для рейтинга в памяти"""
+    # Сверка рейтинга со снимком отстающей реплики откатила бы свежие записи
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("SELECT user_id, total FROM user_totals")
+        return cur.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка при получении итогов пользователей: {e}")
+        return []
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_all_totals_snapshot():
+    """Возвращает снимок "xmin:xmax:xip,..." и пары (user_id, total) всех пользователей,
+    прочитанные в этом снимке"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        # В REPEATABLE READ оба запроса видят один снимок транзакции
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cur.execute("SELECT pg_current_snapshot()::text")
+        snapshot = cur.fetchone()[0]
+        cur.execute("SELECT user_id, total FROM user_totals")
+        rows = cur.fetchall()
+        conn.commit()
+        return snapshot, rows
+    except Exception as e:
+        logger.error(f"Ошибка при получении итогов пользователей: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def get_job_run(job_name):
+    """Состояние задачи: last_completed, in_progress, cursor; None, если она еще не запускалась"""
+    conn = get_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        cur.execute("""
+            SELECT last_completed, in_progress, cursor
+            FROM job_runs
+            WHERE job_name = %s
+        """, (job_name,))
+        return cur.fetchone()
+    except Exception as e:
+        logger.error(f"Ошибка при получении состояния задачи {job_name}: {e}")
+        return None
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+@metrics.track_query
+def save_job_run(job_name, last_completed, in_progress=None, cursor=None):
+    """Сохраняет состояние задачи: последний завершенный запуск и прогресс текущего"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute("""
+            INSERT INTO job_runs (job_name, last_completed, in_progress, cursor)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (job_name) DO UPDATE SET
+                last_completed = EXCLUDED.last_completed,
+                in_progress = EXCLUDED.in_progress,
+                cursor = EXCLUDED.cursor,
+                updated_at = CURRENT_TIMESTAMP
+        """, (job_name, last_completed, in_progress, cursor))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния задачи {job_name}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+        release_connection(conn)
@@ -0,0 +1,60 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import database
+from config import DB_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Синхронные функции database.py выполняются в ограниченном пуле потоков,
+# чтобы запросы к БД не блокировали event loop бота и job queue.
+# Размер пула потоков не больше пула соединений, иначе потоки будут ждать соединение.
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+def _run_in_executor(func):
+    """Превращает синхронную функцию БД в корутину с тем же результатом"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+add_user = _run_in_executor(database.add_user)
+add_pullups = _run_in_executor(database.add_pullups)
+add_pullups_and_summarize = _run_in_executor(database.add_pullups_and_summarize)
+get_user_total = _run_in_executor(database.get_user_total)
+get_user_stats = _run_in_executor(database.get_user_stats)
+get_stats_for_users = _run_in_executor(database.get_stats_for_users)
+get_leaderboard = _run_in_executor(database.get_leaderboard)
+get_leaderboard_page = _run_in_executor(database.get_leaderboard_page)
+get_leaderboard_around = _run_in_executor(database.get_leaderboard_around)
+get_user_rank = _run_in_executor(database.get_user_rank)
+add_chat_members = _run_in_executor(database.add_chat_members)
+remove_chat_members = _run_in_executor(database.remove_chat_members)
+move_chat_members = _run_in_executor(database.move_chat_members)
+get_chat_leaderboard = _run_in_executor(database.get_chat_leaderboard)
+get_today_pullups = _run_in_executor(database.get_today_pullups)
+get_last_pullup = _run_in_executor(database.get_last_pullup)
+delete_pullup = _run_in_executor(database.delete_pullup)
+undo_last_pullups = _run_in_executor(database.undo_last_pullups)
+get_all_users = _run_in_executor(database.get_all_users)
+deactivate_users = _run_in_executor(database.deactivate_users)
+get_reminder_settings = _run_in_executor(database.get_reminder_settings)
+set_reminder_settings = _run_in_executor(database.set_reminder_settings)
+get_reminder_timezones = _run_in_executor(database.get_reminder_timezones)
+get_due_reminder_users = _run_in_executor(database.get_due_reminder_users)
+get_all_totals = _run_in_executor(database.get_all_totals)
+compact_pullups = _run_in_executor(database.compact_pullups)
+ensure_pullups_partitions = _run_in_executor(database.ensure_pullups_partitions)
+try_acquire_job_lock = _run_in_executor(database.try_acquire_job_lock)
+get_job_run = _run_in_executor(database.get_job_run)
+save_job_run = _run_in_executor(database.save_job_run)
+
+
+def shutdown():
+    """Дожидается завершения запросов в пуле потоков"""
+    _executor.shutdown(wait=True)
+    logger.info("Пул потоков БД остановлен")
@@ -0,0 +1,86 @@
+import logging
+from telegram import Chat, ChatMember
+import database_async as adb
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMembers:
+    """Участники групповых чатов для рейтингов по чату.
+
+    Бот не может получить список участников чата, поэтому участником считается
+    тот, кого бот видел в чате: автор сообщения или команды и добавленные в чат
+    пользователи. Вышедшие участники удаляются, а если из чата удалили бота -
+    удаляются все участники чата. Уже записанные пары (чат, пользователь)
+    запоминаются в памяти, чтобы не писать в БД на каждое сообщение.
+    """
+
+    def __init__(self, max_known=100000):
+        self.max_known = max_known
+        self._known = set()  # (chat_id, user_id), уже записанные в БД
+
+    async def seen(self, chat_id, user_ids):
+        """Записывает участников, которых этот экземпляр еще не записывал"""
+        new = [user_id for user_id in user_ids if (chat_id, user_id) not in self._known]
+        if not new or not await adb.add_chat_members(chat_id, new):
+            return
+        if len(self._known) + len(new) > self.max_known:
+            # Повторная запись безвредна (ON CONFLICT), поэтому память просто сбрасывается
+            self._known.clear()
+        self._known.update((chat_id, user_id) for user_id in new)
+
+    async def left(self, chat_id, user_id):
+        self._known.discard((chat_id, user_id))
+        await adb.remove_chat_members(chat_id, [user_id])
+
+    async def chat_removed(self, chat_id):
+        self._known = {key for key in self._known if key[0] != chat_id}
+        await adb.remove_chat_members(chat_id)
+        logger.info(f"Бот удален из чата {chat_id}, участники чата удалены")
+
+    async def chat_migrated(self, old_chat_id, new_chat_id):
+        self._known = {key for key in self._known if key[0] != old_chat_id}
+        await adb.move_chat_members(old_chat_id, new_chat_id)
+        logger.info(f"Чат {old_chat_id} стал супергруппой {new_chat_id}, участники перенесены")
+
+    async def track(self, update, bot_id):
+        """Обновляет участников по обновлению из группового чата"""
+        chat = update.effective_chat
+        if chat is None or chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+            return
+
+        if update.my_chat_member:
+            if update.my_chat_member.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED):
+                await self.chat_removed(chat.id)
+            return
+
+        message = update.effective_message
+        if message is not None:
+            if message.migrate_to_chat_id:
+                await self.chat_migrated(chat.id, message.migrate_to_chat_id)
+                return
+            if message.left_chat_member:
+                if message.left_chat_member.id == bot_id:
+                    await self.chat_removed(chat.id)
+                else:
+                    await self.left(chat.id, message.left_chat_member.id)
+                return
+            if message.new_chat_members:
+                await self.seen(chat.id, [user.id for user in message.new_chat_members if not user.is_bot])
+
+        user = update.effective_user
+        if user is not None and not user.is_bot:
+            await self.seen(chat.id, [user.id])
+
+
+members = ChatMembers()
+
+
+@metrics.track_handler
+async def track_chat_members(update, context):
+    """Обработчик всех обновлений (группа -1): запоминает участников групповых чатов"""
+    try:
+        await members.track(update, context.bot.id)
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении участников чата: {e}")
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderboardCache:
+    """Снимок топа лидерборда вместе с готовым текстом.
+
+    Снимок живет не дольше ttl секунд. Записи, которые могут изменить топ,
+    либо применяются к снимку на месте (рост суммы участника топа), либо
+    сбрасывают его. Одновременные промахи ждут один общий запрос к БД.
+    Выданные списки строк не меняются: изменение собирает новый список.
+    """
+
+    def __init__(self, fetch, render, limit=20, ttl=30, total_lookup=None):
+        self._fetch = fetch                # async fetch(limit) -> строки лидерборда
+        self._render = render              # render(rows) -> текст
+        self._total_lookup = total_lookup  # total_lookup(user_id) -> сумма или None
+        self.limit = limit
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = None
+        self._rows = None
+        self._text = None
+        self._loaded_at = 0.0
+        self._valid = False
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.incremental_updates = 0
+
+    def _is_fresh(self):
+        return self._valid and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self):
+        """Возвращает (строки, текст) топа, обращаясь к БД только при промахе"""
+        with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._rows, self._text
+
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            with self._lock:
+                if self._is_fresh():
+                    self.hits += 1
+                    return self._rows, self._text
+                self.misses += 1
+                version = self._version
+
+            rows = [dict(row) for row in await self._fetch(self.limit)]
+            text = self._render(rows) if rows else None
+
+            with self._lock:
+                self._rows = rows
+                self._text = text
+                self._loaded_at = time.monotonic()
+                # Если во время запроса была запись, снимок мог ее не увидеть
+                self._valid = version == self._version
+                logger.info(
+                    f"Лидерборд загружен из БД (попаданий: {self.hits}, промахов: {self.misses})"
+                )
+                return rows, text
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidate()
+
+    def _invalidate(self):
+        self._version += 1
+        if self._valid:
+            self._valid = False
+            self.invalidations += 1
+
+    def on_write(self, user_id, delta):
+        """Обработчик изменений из database.add_write_listener"""
+        with self._lock:
+            if self._rows is None:
+                return
+
+            row = next((r for r in self._rows if r['user_id'] == user_id), None)
+            if row is not None:
+                if delta < 0:
+                    # Участник топа мог опуститься ниже кого-то за пределами снимка
+                    self._invalidate()
+                    return
+                # Выданный снимок не меняется: читатели в других потоках могут
+                # держать его, поэтому собирается новый список и подменяется целиком
+                rows = [dict(r, total=r['total'] + delta) if r is row else r for r in self._rows]
+                rows.sort(key=lambda r: (-r['total'], r['user_id']))
+                self._rows = rows
+                self._text = self._render(rows)
+                self._version += 1
+                self.incremental_updates += 1
+                return
+
+            if len(self._rows) < self.limit:
+                self._invalidate()
+                return
+            if delta <= 0:
+                return
+
+            # Сбрасываем снимок, только если пользователь мог войти в топ
+            total = self._total_lookup(user_id) if self._total_lookup else None
+            last = self._rows[-1]
+            if total is None or (total, -user_id) > (last['total'], -last['user_id']):
+                self._invalidate()
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'incremental_updates': self.incremental_updates,
+            }
@@ -0,0 +1,119 @@
+import argparse
+import logging
+import sys
+from datetime import date, timedelta
+import config
+import database as db
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def migrate(args):
+    """Применяет недостающие миграции схемы и показывает ее версию"""
+    # Сами миграции применяет init_database перед любой командой
+    print(f"Версия схемы БД: {db.get_schema_version()} (последняя известная: {db.SCHEMA_VERSION})")
+    return 0
+
+
+def rebuild_totals(args):
+    """Сверяет user_totals с pullups и перестраивает таблицу"""
+    drift = db.rebuild_user_totals(apply=not args.check)
+
+    for row in drift[:args.limit]:
+        print(
+            f"user {row['user_id']}: "
+            f"total {row['actual_total']} -> {row['expected_total']}, "
+            f"records {row['actual_records']} -> {row['expected_records']}, "
+            f"days {row['actual_days']} -> {row['expected_days']}, "
+            f"today {row['actual_today']} -> {row['expected_today']}"
+        )
+    if len(drift) > args.limit:
+        print(f"... и еще {len(drift) - args.limit}")
+
+    action = "найдено" if args.check else "исправлено"
+    print(f"Расхождений {action}: {len(drift)}")
+    return 1 if drift and args.check else 0
+
+
+def rebuild_streaks(args):
+    """Пересчитывает серии дней подряд по pullups_daily"""
+    changed = db.rebuild_streaks()
+    print(f"Серии исправлены у пользователей: {changed}")
+    return 0
+
+
+def compact(args):
+    """Сворачивает старые записи pullups в pullups_daily и удаляет их"""
+    before = date.today() - timedelta(days=args.days)
+    removed = db.compact_pullups(before, batch_size=args.batch_size)
+    print(f"Уплотнено записей раньше {before}: {removed}")
+    return 0
+
+
+def partition_pullups(args):
+    """Переносит обычную таблицу pullups в секционированную по месяцам"""
+    moved = db.partition_pullups_table()
+    if moved is None:
+        print("Таблица pullups уже секционирована")
+    else:
+        print(f"Таблица pullups секционирована, перенесено записей: {moved}")
+    return 0
+
+
+def main():
+    """Служебные команды обслуживания базы данных"""
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate',
+        help="применить миграции схемы БД (например, до запуска новых экземпляров бота)"
+    )
+    migrate_parser.set_defaults(func=migrate)
+
+    rebuild = subparsers.add_parser(
+        'rebuild-totals',
+        help="пересчитать user_totals по таблице pullups и показать расхождения"
+    )
+    rebuild.add_argument('--check', action='store_true', help="только проверить, ничего не менять")
+    rebuild.add_argument('--limit', type=int, default=50, help="сколько расхождений вывести")
+    rebuild.set_defaults(func=rebuild_totals)
+
+    streaks_parser = subparsers.add_parser(
+        'rebuild-streaks',
+        help="пересчитать серии дней подряд (текущую и лучшую) по суммам за дни"
+    )
+    streaks_parser.set_defaults(func=rebuild_streaks)
+
+    compact_parser = subparsers.add_parser(
+        'compact',
+        help="свернуть записи pullups старше N дней в суммы по дням и удалить их"
+    )
+    compact_parser.add_argument(
+        '--days', type=int, default=config.PULLUPS_COMPACT_AFTER_DAYS or 90,
+        help="возраст записей в днях (по умолчанию PULLUPS_COMPACT_AFTER_DAYS или 90)"
+    )
+    compact_parser.add_argument('--batch-size', type=int, default=db.COMPACT_BATCH_SIZE,
+                                help="записей в одной транзакции")
+    compact_parser.set_defaults(func=compact)
+    
+    partition_parser = subparsers.add_parser(
+        'partition-pullups',
+        help="перенести pullups в секционированную по месяцам таблицу (блокирует запись на время переноса)"
+    )
+    partition_parser.set_defaults(func=partition_pullups)
+    
+    args = parser.parse_args()
+    try:
+        db.init_database()
+        return args.func(args)
+    finally:
+        db.close_pool()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
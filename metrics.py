@@ -0,0 +1,370 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # значения меток -> значение
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получено {labels}")
+        return tuple(str(value) for value in labels)
+
+    def _samples(self):
+        """Строки (суффикс, значения меток, доп. метка, значение) для вывода"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, extra, value in self._samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Текущее значение; с func значение читается при каждом выводе"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super().__init__(name, documentation, labelnames)
+        self._func = func  # func() -> {значения меток: значение}
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self._func is not None:
+            values = {self._key(labels): value for labels, value in self._func().items()}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', key, None, value) for key, value in sorted(values.items())]
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам, плюс их сумма и количество"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = _HistogramValue(len(self.buckets))
+            item.buckets[index] += 1
+            item.sum += value
+            item.count += 1
+
+    def time(self, *labels):
+        """Контекстный менеджер, измеряющий время блока"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        """{значения меток: (количество, сумма, квантиль 0.95)} для сводки /stats"""
+        with self._lock:
+            items = {key: (item.count, item.sum, list(item.buckets)) for key, item in self._values.items()}
+        return {
+            key: (count, total, self._quantile(buckets, count, 0.95))
+            for key, (count, total, buckets) in items.items()
+        }
+
+    def _quantile(self, buckets, count, q):
+        """Оценка квантиля сверху: граница корзины, в которую он попал"""
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(self.buckets, buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound if bound != float('inf') else self.buckets[-2]
+        return 0.0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(
+                (key, list(item.buckets), item.sum, item.count) for key, item in self._values.items()
+            )
+        samples = []
+        for key, buckets, total, count in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                samples.append(('_bucket', key, ('le', _format_value(bound)), cumulative))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, count))
+        return samples
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labels', '_started')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, *self._labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Ошибка при выводе метрики {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Обработчики бота
+HANDLER_DURATION = Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчика бота', ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках бота', ['handler']
+)
+
+# База данных
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Время выполнения функции database.py', ['function']
+)
+DB_ERRORS = Counter(
+    'db_errors_total', 'Ошибки в функциях database.py (включая перехваченные)', ['function']
+)
+DB_CONNECTION_ACQUIRE = Histogram(
+    'db_connection_acquire_seconds', 'Время ожидания соединения из пула'
+)
+DB_READS = Counter(
+    'db_reads_total', 'Чтения при заданной реплике: replica, primary (свои записи), fallback', ['target']
+)
+DB_SLOW_QUERIES = Counter(
+    'db_slow_queries_total', 'Запросы дольше SLOW_QUERY_THRESHOLD_MS, записанные в журнал'
+)
+
+# Уведомления об изменениях от других экземпляров
+CHANGE_EVENTS = Counter(
+    'change_events_total',
+    'Уведомления об изменениях сумм: applied, own (свои записи), resynced (уже учтены сверкой), invalid',
+    ['result']
+)
+CHANGE_LAG = Histogram(
+    'change_event_lag_seconds', 'Задержка от записи в БД до получения уведомления экземпляром'
+)
+CHANGE_LISTENER_RECONNECTS = Counter(
+    'change_listener_reconnects_total', 'Переподключения слушателя уведомлений об изменениях'
+)
+
+# Напоминания
+REMINDER_RUN_DURATION = Histogram(
+    'reminder_run_duration_seconds', 'Длительность рассылки напоминаний',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+REMINDER_MESSAGES = Counter(
+    'reminder_messages_total', 'Напоминания по результату отправки', ['result']
+)
+REMINDER_RETRIES = Counter(
+    'reminder_retries_total', 'Повторные попытки отправки напоминаний'
+)
+REMINDER_THROTTLE_WAIT = Counter(
+    'reminder_throttle_wait_seconds_total', 'Суммарное ожидание лимитов Telegram при рассылке'
+)
+
+
+# Метка обработчика текущего обновления: [имя], которое может уточнить label_handler
+_handler_label = contextvars.ContextVar('handler_label', default=None)
+
+
+def track_handler(func):
+    """Декоратор асинхронного обработчика: время, вызовы и исключения.
+
+    Ставится только на обработчики, зарегистрированные в Application: если
+    отмеченные обработчики вызывают друг друга, одно обновление считается
+    несколько раз. Обработчик, который сам выбирает действие (например, по
+    нажатой кнопке), уточняет метку через label_handler.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        label = [name]
+        token = _handler_label.set(label)
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(label[0])
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, label[0])
+            _handler_label.reset(token)
+    return wrapper
+
+
+def label_handler(name):
+    """Записывает текущее обновление в метрики под именем выбранного действия"""
+    label = _handler_label.get()
+    if label is not None:
+        label[0] = name
+
+
+def track_query(func):
+    """Декоратор функции БД: время, вызовы и исключения"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        logged = _logged_errors()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            # Ошибку, записанную в лог во время вызова, уже посчитал ErrorLogCounter
+            if _logged_errors() == logged:
+                DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+# Число записей ERROR, посчитанных ErrorLogCounter в этом потоке
+_error_records = threading.local()
+
+
+def _logged_errors():
+    return getattr(_error_records, 'count', 0)
+
+
+class ErrorLogCounter(logging.Handler):
+    """Считает ошибки, которые функции БД записывают в лог.
+
+    Функции database.py при ошибке пишут logger.error и возвращают значение
+    по умолчанию, поэтому такие ошибки считаются по записям лога уровня ERROR
+    с именем функции, из которой они записаны. Если функция после записи в лог
+    пробрасывает исключение, track_query его повторно не считает.
+    """
+
+    def __init__(self, counter):
+        super().__init__(level=logging.ERROR)
+        self.counter = counter
+
+    def emit(self, record):
+        self.counter.inc(record.funcName)
+        _error_records.count = _logged_errors() + 1
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """Запускает HTTP-сервер с /metrics в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,163 @@
+import logging
+import threading
+from bisect import bisect_left, insort
+import database as db
+import database_async as adb
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class RankIndex:
+    """Рейтинг пользователей в памяти.
+
+    Ключи (-total, user_id) хранятся в отсортированном списке, поэтому порядок
+    совпадает с SQL: total DESC, user_id ASC. Позиция пользователя находится
+    двоичным поиском за O(log n), срез рейтинга - за O(limit). Изменение суммы -
+    два двоичных поиска и сдвиг хвоста списка; память и время не зависят от
+    величины сумм, только от числа пользователей.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # user_id -> total
+        self._order = []   # отсортированные ключи (-total, user_id)
+        self._touched = None
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._totals)
+
+    def _remove(self, user_id):
+        total = self._totals.pop(user_id)
+        del self._order[bisect_left(self._order, (-total, user_id))]
+
+    def _insert(self, user_id, total):
+        self._totals[user_id] = total
+        insort(self._order, (-total, user_id))
+
+    def load(self, rows):
+        """Загружает пары (user_id, total) целиком"""
+        with self._lock:
+            self._totals = {user_id: total for user_id, total in rows}
+            self._order = sorted((-total, user_id) for user_id, total in self._totals.items())
+            self.loaded = True
+
+    def apply(self, user_id, delta):
+        """Применяет изменение суммы пользователя (delta=0 - новый пользователь)"""
+        with self._lock:
+            total = self._totals.get(user_id, 0) + delta
+            if user_id in self._totals:
+                self._remove(user_id)
+            self._insert(user_id, max(total, 0))
+            if self._touched is not None:
+                self._touched.add(user_id)
+
+    def get_total(self, user_id):
+        with self._lock:
+            return self._totals.get(user_id)
+
+    def rank(self, user_id):
+        """Позиция пользователя в рейтинге (с 1) или None"""
+        with self._lock:
+            total = self._totals.get(user_id)
+            if total is None:
+                return None
+            return bisect_left(self._order, (-total, user_id)) + 1
+
+    def slice(self, start, limit):
+        """Пары (user_id, total) на позициях start..start+limit-1 рейтинга"""
+        with self._lock:
+            offset = max(start, 1) - 1
+            return [(user_id, -key) for key, user_id in self._order[offset:offset + limit]]
+
+    def top(self, limit):
+        return self.slice(1, limit)
+
+    def begin_reconcile(self):
+        """Начинает сверку: запоминает пользователей, изменившихся во время чтения из БД"""
+        with self._lock:
+            self._touched = set()
+
+    def reconcile(self, rows):
+        """Сверяет индекс со снимком из БД и исправляет расхождения; возвращает их число"""
+        with self._lock:
+            touched = self._touched or set()
+            self._touched = None
+            expected = {user_id: total for user_id, total in rows if user_id not in touched}
+            drift = 0
+            for user_id, total in expected.items():
+                if self._totals.get(user_id) != total:
+                    drift += 1
+                    if user_id in self._totals:
+                        self._remove(user_id)
+                    self._insert(user_id, total)
+            for user_id in [u for u in self._totals if u not in expected and u not in touched]:
+                drift += 1
+                self._remove(user_id)
+            return drift
+
+
+index = RankIndex()
+
+
+def load():
+    """Загружает рейтинг из БД и подписывает его на изменения"""
+    index.load(db.get_all_totals())
+    db.add_write_listener(index.apply)
+    logger.info(f"Рейтинг загружен: {len(index)} пользователей")
+
+
+def resync():
+    """Сверяет индекс с БД целиком, например после пропущенных уведомлений об изменениях;
+    возвращает снимок БД, по которому он сверен"""
+    index.begin_reconcile()
+    snapshot, rows = db.get_all_totals_snapshot()
+    drift = index.reconcile(rows)
+    if drift:
+        logger.warning(f"Рейтинг разошелся с БД у {drift} пользователей, исправлено")
+    return snapshot
+
+
+async def get_user_rank(user_id):
+    """Позиция пользователя из индекса, а пока индекс не загружен - из БД"""
+    rank = index.rank(user_id) if index.loaded else None
+    if rank is None:
+        rank = await adb.get_user_rank(user_id)
+    return rank
+
+
+async def get_user_total(user_id):
+    """Сумма пользователя из индекса, а пока индекс не загружен - из БД"""
+    total = index.get_total(user_id) if index.loaded else None
+    if total is None:
+        total = await adb.get_user_total(user_id)
+    return total
+
+
+async def reconcile_job(context):
+    """Периодическая сверка индекса с user_totals"""
+    try:
+        index.begin_reconcile()
+        rows = await adb.get_all_totals()
+        drift = index.reconcile(rows)
+        if drift:
+            logger.warning(f"Рейтинг разошелся с БД у {drift} пользователей, исправлено")
+    except Exception as e:
+        logger.error(f"Ошибка при сверке рейтинга: {e}")
+
+
+def setup_ranking(application):
+    """Загружает рейтинг и настраивает периодическую сверку"""
+    load()
+
+    job_queue = application.job_queue
+    if job_queue:
+        job_queue.run_repeating(
+            reconcile_job,
+            interval=config.RANK_RECONCILE_INTERVAL,
+            first=config.RANK_RECONCILE_INTERVAL,
+            name="rank_reconcile"
+        )
+    else:
+        logger.warning("Job queue не доступен, сверка рейтинга не будет работать")
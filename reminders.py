@@ -1,89 +1,223 @@
-import asyncio
 import logging
-from datetime import datetime, time, date
+from datetime import datetime, time, date, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram.ext import ContextTypes
-import database as db
+import database_async as adb
 import config
+import metrics
+from broadcast import FanOut
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Отправляет напоминание пользователю"""
-    try:
-        stats = db.get_user_stats(user_id)
-        total = stats['total']
-        progress = stats['progress_percent']
-        avg_per_day = stats['avg_per_day']
-        
-        # Рассчитываем сколько нужно сделать сегодня для достижения цели
-        today = date.today()
-        days_passed = max(1, (today - config.CHALLENGE_START_DATE).days + 1)
-        days_remaining = (config.CHALLENGE_END_DATE - today).days
-        
-        if days_remaining > 0:
-            needed_per_day = (config.CHALLENGE_TARGET - total) / days_remaining
-        else:
-            needed_per_day = 0
-        
-        reminder_text = (
-            f"⏰ Напоминание о челлендже подтягиваний! 💪\n\n"
-            f"📊 Твой прогресс:\n"
-            f"🎯 Всего: {total:,} подтягиваний\n"
-            f"✅ Прогресс: {progress:.1f}%\n"
-            f"📈 Среднее в день: {avg_per_day}\n\n"
+def build_reminder_text(stats: dict):
+    """Формирует текст напоминания по статистике пользователя"""
+    total = stats['total']
+    progress = stats['progress_percent']
+    avg_per_day = stats['avg_per_day']
+    
+    # Рассчитываем сколько нужно сделать сегодня для достижения цели
+    today = date.today()
+    days_remaining = (config.CHALLENGE_END_DATE - today).days
+    
+    if days_remaining > 0:
+        needed_per_day = (config.CHALLENGE_TARGET - total) / days_remaining
+    else:
+        needed_per_day = 0
+    
+    reminder_text = (
+        f"⏰ Напоминание о челлендже подтягиваний! 💪\n\n"
+        f"📊 Твой прогресс:\n"
+        f"🎯 Всего: {total:,} подтягиваний\n"
+        f"✅ Прогресс: {progress:.1f}%\n"
+        f"📈 Среднее в день: {avg_per_day}\n"
+    )
+    
+    # Текущая серия продолжится, только если записать подтягивания сегодня
+    if stats['current_streak'] > 0:
+        reminder_text += f"🔥 Серия: {stats['current_streak']} дн. подряд - не прерывай ее!\n\n"
+    else:
+        reminder_text += f"🔥 Лучшая серия: {stats['longest_streak']} дн. подряд\n\n"
+    
+    if days_remaining > 0 and needed_per_day > 0:
+        reminder_text += (
+            f"📅 Осталось дней: {days_remaining}\n"
+            f"🎯 Нужно в день для цели: {needed_per_day:.1f}\n\n"
         )
-        
-        if days_remaining > 0 and needed_per_day > 0:
-            reminder_text += (
-                f"📅 Осталось дней: {days_remaining}\n"
-                f"🎯 Нужно в день для цели: {needed_per_day:.1f}\n\n"
+    
+    reminder_text += "Не забудь записать свои подтягивания сегодня! 💪"
+    return reminder_text
+
+
+# Рассылка идет частями по столько пользователей, после каждой части сохраняется
+# прогресс: после перезапуска рассылка продолжается со следующей части
+REMINDER_BATCH_SIZE = 500
+
+
+async def send_reminders(context: ContextTypes.DEFAULT_TYPE, users: list, on_batch=None):
+    """Рассылает напоминания списку пользователей.
+
+    Пользователи отправляются частями по REMINDER_BATCH_SIZE в порядке списка,
+    после каждой части вызывается await on_batch(последний пользователь части).
+    """
+    # Параллельная рассылка в пределах лимитов Telegram API
+    fanout = FanOut(
+        context.bot,
+        rate=config.BROADCAST_RATE,
+        per_chat_rate=config.BROADCAST_PER_CHAT_RATE,
+        concurrency=config.BROADCAST_CONCURRENCY,
+        max_retries=config.BROADCAST_MAX_RETRIES
+    )
+    with metrics.REMINDER_RUN_DURATION.time():
+        for start in range(0, len(users), REMINDER_BATCH_SIZE):
+            batch = users[start:start + REMINDER_BATCH_SIZE]
+            # Статистика части одним запросом вместо запроса на каждого
+            all_stats = await adb.get_stats_for_users(batch)
+            await fanout.send_all(
+                (user_id, build_reminder_text(all_stats[user_id]))
+                for user_id in batch if user_id in all_stats
             )
-        
-        reminder_text += "Не забудь записать свои подтягивания сегодня! 💪"
-        
-        await context.bot.send_message(chat_id=user_id, text=reminder_text)
-        logger.info(f"Напоминание отправлено пользователю {user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
+            if on_batch is not None:
+                await on_batch(batch[-1])
+    summary = fanout.summary(fanout.elapsed)
+    metrics.REMINDER_MESSAGES.inc('sent', amount=summary['sent'])
+    metrics.REMINDER_MESSAGES.inc('failed', amount=summary['failed'])
+    metrics.REMINDER_MESSAGES.inc('blocked', amount=summary['blocked'])
+    metrics.REMINDER_RETRIES.inc(amount=summary['retries'])
+    metrics.REMINDER_THROTTLE_WAIT.inc(amount=summary['throttle_wait'])
+    
+    if fanout.blocked:
+        await adb.deactivate_users(fanout.blocked)
+        logger.info(f"Помечены неактивными {len(fanout.blocked)} пользователей, заблокировавших бота")
 
 
-async def daily_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Ежедневная задача для отправки напоминаний всем пользователям"""
+def parse_reminder_time(value):
+    """Разбирает время HH:MM, возвращает None при неверном формате"""
     try:
-        users = db.get_all_users()
-        logger.info(f"Отправка напоминаний {len(users)} пользователям")
+        hour, minute = map(int, value.split(':'))
+        return time(hour, minute)
+    except (ValueError, AttributeError):
+        return None
+
+
+def get_default_reminder_time():
+    """Время напоминаний для пользователей, не выбравших свое"""
+    reminder_time = parse_reminder_time(config.REMINDER_TIME)
+    if reminder_time is None:
+        logger.warning(f"Неверный формат времени напоминания: {config.REMINDER_TIME}, используем 09:00")
+        reminder_time = time(9, 0)
+    return reminder_time
+
+
+def get_reminder_slots(moment: datetime, timezones: list):
+    """Слоты, наступившие в минуту moment (UTC) в каждом часовом поясе.
+
+    Возвращает явные слоты (часовой пояс, локальное время) для пользователей
+    со своим временем и слоты по умолчанию (часовой пояс, сдвиг) для остальных:
+    они получают напоминание в REMINDER_TIME + user_id % REMINDER_SPREAD_MINUTES минут.
+    """
+    default = get_default_reminder_time()
+    default_minute = default.hour * 60 + default.minute
+    spread = max(1, config.REMINDER_SPREAD_MINUTES)
+    
+    slots = []
+    default_slots = []
+    for tz_name in timezones:
+        try:
+            local = moment.astimezone(ZoneInfo(tz_name))
+        except (ZoneInfoNotFoundError, ValueError, OSError):
+            logger.warning(f"Неизвестный часовой пояс у пользователей: {tz_name}")
+            continue
+        slots.append((tz_name, time(local.hour, local.minute)))
+        offset = (local.hour * 60 + local.minute - default_minute) % (24 * 60)
+        if offset < spread:
+            default_slots.append((tz_name, offset))
+    return slots, default_slots
+
+
+def parse_reminder_policy(value):
+    """Разбирает REMINDER_POLICY в словарь фильтров для get_due_reminder_users"""
+    policy = {'not_logged_today': False, 'active_days': None, 'behind_plan': False}
+    for item in (value or '').split(','):
+        name, _, arg = item.strip().partition('=')
+        if name in ('', 'all'):
+            continue
+        if name == 'not_logged_today':
+            policy['not_logged_today'] = True
+        elif name == 'behind_plan':
+            policy['behind_plan'] = True
+        elif name == 'active_days' and arg.isdecimal():
+            policy['active_days'] = int(arg)
+        else:
+            logger.warning(f"Неизвестное правило напоминаний: {item.strip()}")
+    return policy
+
+
+REMINDER_JOB = 'reminder_tick'
+
+
+async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Ежеминутная задача: рассылает напоминания пользователям, чья минута наступила.
+
+    Рассылает только экземпляр-лидер задачи. Последняя разосланная минута и
+    прогресс текущей хранятся в job_runs, поэтому новый лидер или перезапущенный
+    бот догоняет пропущенные минуты и не повторяет уже отправленные части.
+    """
+    try:
+        if not await adb.try_acquire_job_lock(REMINDER_JOB):
+            return
+        
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        run = await adb.get_job_run(REMINDER_JOB) or {}
+        last_completed = run.get('last_completed')
+        # Если рассылка стояла дольше 10 минут, догоняем только последние 10
+        if last_completed is None or now - last_completed > timedelta(minutes=10):
+            last_completed = now - timedelta(minutes=1)
         
-        for user_id in users:
-            await send_reminder(context, user_id)
-            # Небольшая задержка между отправками, чтобы не превысить лимиты API
-            await asyncio.sleep(0.1)
+        timezones = await adb.get_reminder_timezones()
+        policy = context.job.data
+        while last_completed < now:
+            moment = last_completed + timedelta(minutes=1)
+            slots, default_slots = get_reminder_slots(moment, timezones)
+            users = sorted(await adb.get_due_reminder_users(
+                slots, default_slots, config.REMINDER_SPREAD_MINUTES, policy
+            ))
+            if run.get('in_progress') == moment and run.get('cursor') is not None:
+                users = [user_id for user_id in users if user_id > run['cursor']]
+                logger.info(f"Продолжаем рассылку за {moment.strftime('%H:%M')} UTC после {run['cursor']}")
+            if users:
+                logger.info(f"Напоминания за {moment.strftime('%H:%M')} UTC: {len(users)} пользователей")
+                
+                async def save_progress(last_user_id, completed=last_completed, moment=moment):
+                    await adb.save_job_run(REMINDER_JOB, completed, moment, last_user_id)
+                
+                await send_reminders(context, users, on_batch=save_progress)
+            last_completed = moment
+            await adb.save_job_run(REMINDER_JOB, last_completed)
             
     except Exception as e:
-        logger.error(f"Ошибка при отправке ежедневных напоминаний: {e}")
+        logger.error(f"Ошибка при отправке напоминаний: {e}")
 
 
 def setup_reminders(application):
     """Настраивает расписание напоминаний"""
-    # Парсим время напоминания
-    try:
-        hour, minute = map(int, config.REMINDER_TIME.split(':'))
-        reminder_time = time(hour, minute)
-    except:
-        logger.warning(f"Неверный формат времени напоминания: {config.REMINDER_TIME}, используем 09:00")
-        reminder_time = time(9, 0)
-    
-    # Добавляем задачу на ежедневное напоминание
     job_queue = application.job_queue
     
     if job_queue:
-        job_queue.run_daily(
-            daily_reminder,
-            time=reminder_time,
-            name="daily_reminder"
+        # Каждую минуту отправляем небольшую пачку тем, у кого наступило время
+        now = datetime.now(timezone.utc)
+        job_queue.run_repeating(
+            reminder_tick,
+            interval=60,
+            first=60 - now.second - now.microsecond / 1_000_000,
+            name="reminder_tick",
+            data=parse_reminder_policy(config.REMINDER_POLICY)
+        )
+        logger.info(
+            f"Напоминания по умолчанию в {get_default_reminder_time().strftime('%H:%M')} "
+            f"(+ до {config.REMINDER_SPREAD_MINUTES} мин) по часовому поясу пользователя, "
+            f"правило: {config.REMINDER_POLICY}"
         )
-        logger.info(f"Напоминания настроены на {reminder_time.strftime('%H:%M')} UTC")
     else:
         logger.warning("Job queue не доступен, напоминания не будут работать")
-
@@ -0,0 +1,39 @@
+import json
+import unittest
+import change_listener
+from change_listener import ChangeListener
+
+
+class ResyncSnapshotTest(unittest.TestCase):
+    """События транзакций, вошедших в снимок сверки, не применяются второй раз"""
+
+    def setUp(self):
+        self.applied = []
+        self.listener = ChangeListener(
+            lambda user_id, delta: self.applied.append((user_id, delta)),
+            lambda: None, origin='me'
+        )
+        # Транзакции 102 и 104 шли во время снимка, 105 и дальше - после него
+        self.listener._snapshot = change_listener._parse_snapshot('100:105:102,104')
+
+    def handle(self, xid, user_id=1, delta=10):
+        event = {'u': user_id, 'd': delta, 'o': 'other', 't': 0}
+        if xid is not None:
+            event['x'] = str(xid)
+        self.listener._handle(json.dumps(event))
+
+    def test_skips_events_in_snapshot(self):
+        self.handle(99)
+        self.handle(103)
+        self.assertEqual(self.applied, [])
+
+    def test_applies_events_after_snapshot(self):
+        self.handle(102, user_id=2)
+        self.handle(104, user_id=4)
+        self.handle(105, user_id=5)
+        self.handle(None, user_id=6)
+        self.assertEqual(self.applied, [(2, 10), (4, 10), (5, 10), (6, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
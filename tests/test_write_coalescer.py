@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from write_coalescer import WriteCoalescer
+
+
+class UndoDuringTimerFlushTest(unittest.IsolatedAsyncioTestCase):
+    """Undo, нажатый во время записи буфера по таймеру, ждет ее коммита"""
+
+    async def asyncSetUp(self):
+        self.events = []
+        self.write_started = asyncio.Event()
+        self.commit = asyncio.Event()
+
+        async def write(user, counts, pullup_date):
+            self.events.append(('insert-start', counts))
+            self.write_started.set()
+            await self.commit.wait()
+            self.events.append(('insert-commit', counts))
+            return {'today': sum(counts), 'total': sum(counts)}
+
+        async def reply(message, counts, summary):
+            pass
+
+        self.coalescer = WriteCoalescer(write, reply, window=0.01)
+        self.user = SimpleNamespace(id=1)
+
+    async def undo(self):
+        # Так обработчики кнопок и /undo сбрасывают буфер перед чтением
+        await self.coalescer.flush(self.user.id)
+        self.events.append(('undo-runs',))
+
+    async def test_undo_waits_for_timer_write(self):
+        await self.coalescer.add(self.user, 10, message=None)
+        await asyncio.wait_for(self.write_started.wait(), 1)
+
+        undo = asyncio.create_task(self.undo())
+        await asyncio.sleep(0.05)
+        self.assertFalse(undo.done())
+
+        self.commit.set()
+        await asyncio.wait_for(undo, 1)
+        self.assertEqual(
+            self.events,
+            [('insert-start', [10]), ('insert-commit', [10]), ('undo-runs',)]
+        )
+
+    async def test_next_batch_waits_for_timer_write(self):
+        await self.coalescer.add(self.user, 10, message=None)
+        await asyncio.wait_for(self.write_started.wait(), 1)
+
+        # Новое число во время записи по таймеру пишется после нее
+        self.coalescer.window = 0
+        second = asyncio.create_task(self.coalescer.add(self.user, 12, message=None))
+        await asyncio.sleep(0.05)
+        self.commit.set()
+        await asyncio.wait_for(second, 1)
+        self.assertEqual(
+            self.events,
+            [('insert-start', [10]), ('insert-commit', [10]),
+             ('insert-start', [12]), ('insert-commit', [12])]
+        )
+        self.assertEqual(self.coalescer._writing, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно (не больше
+    concurrency обработчиков сразу), а обновления одного пользователя - строго
+    по очереди, в порядке получения: быстрые "+50" и "Undo" не переставятся.
+    Обновление, ждущее предыдущее обновление своего пользователя, не занимает
+    слот обработчика; таких ожидающих может быть не больше max_pending.
+    """
+
+    def __init__(self, concurrency, max_pending=None):
+        # Семафор базового класса ограничивает число обновлений в работе вместе
+        # с ожидающими, свой семафор - число одновременно работающих обработчиков
+        super().__init__(max_pending or concurrency * 8)
+        self._concurrency = concurrency
+        self._running = None
+        self._user_locks = {}  # user_id -> [asyncio.Lock, число обновлений в очереди]
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        # Очередь asyncio.Lock справедливая, поэтому порядок захвата совпадает
+        # с порядком, в котором приложение запустило обработку обновлений
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self._concurrency)
+        logger.info(f"Параллельная обработка обновлений: до {self._concurrency} одновременно")
+
+    async def shutdown(self):
+        self._user_locks.clear()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    """Записи одного пользователя, ожидающие сброса в БД"""
+
+    def __init__(self, day):
+        self.date = day
+        self.counts = []
+        self.user = None
+        self.message = None
+        self.timer = None
+
+
+class WriteCoalescer:
+    """Объединяет частые записи одного пользователя в одну вставку.
+
+    Числа, присланные подряд в течение window секунд, копятся в буфере и
+    записываются в БД одним многострочным INSERT, после чего пользователь
+    получает одно общее подтверждение. При window <= 0 каждая запись
+    сбрасывается сразу. Записи одного пользователя идут в БД по очереди, а
+    flush возвращается, только когда записано все, что принято до него, -
+    в том числе буфер, который уже записывается по таймеру. Перед остановкой
+    бота нужно вызвать flush_all.
+    """
+
+    def __init__(self, write, reply, window=0.0, max_entries=20):
+        self._write = write  # async write(user, counts, pullup_date) -> {'today', 'total'} или None
+        self._reply = reply  # async reply(message, counts, summary)
+        self.window = window
+        self.max_entries = max_entries
+        self._pending = {}   # user_id -> _Batch
+        self._writing = {}   # user_id -> [asyncio.Lock, число ждущих и пишущих]
+        self.entries = 0
+        self.batches = 0
+        self.failed = 0
+
+    async def add(self, user, count, message):
+        """Добавляет запись в буфер пользователя; ответ придет после сброса"""
+        today = date.today()
+        batch = self._pending.get(user.id)
+        if batch is not None and batch.date != today:
+            # Записи до полуночи не должны попасть в следующий день
+            await self.flush(user.id)
+            batch = None
+        if batch is None:
+            batch = self._pending[user.id] = _Batch(today)
+            if self.window > 0:
+                batch.timer = asyncio.create_task(self._flush_later(user.id, batch))
+
+        batch.counts.append(count)
+        batch.user = user
+        batch.message = message
+        self.entries += 1
+
+        if self.window <= 0 or len(batch.counts) >= self.max_entries:
+            await self.flush(user.id)
+
+    async def _flush_later(self, user_id, batch):
+        await asyncio.sleep(self.window)
+        if self._pending.get(user_id) is batch:
+            await self.flush(user_id)
+
+    async def flush(self, user_id):
+        """Сбрасывает буфер пользователя, например перед чтением его итогов"""
+        batch = self._pending.pop(user_id, None)
+        entry = self._writing.get(user_id)
+        if batch is None and entry is None:
+            return
+        if batch is not None and batch.timer is not None and batch.timer is not asyncio.current_task():
+            batch.timer.cancel()
+
+        # Без буфера ждем запись, начатую раньше (например, по таймеру): иначе
+        # Undo успел бы выполниться до ее коммита и удалил бы не ту запись
+        if entry is None:
+            entry = self._writing[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if batch is not None:
+                    await self._write_batch(user_id, batch)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._writing[user_id]
+
+    async def _write_batch(self, user_id, batch):
+        self.batches += 1
+        try:
+            summary = await self._write(batch.user, batch.counts, batch.date)
+            if summary is None:
+                self.failed += len(batch.counts)
+            await self._reply(batch.message, batch.counts, summary)
+        except Exception as e:
+            logger.error(f"Ошибка при сбросе записей пользователя {user_id}: {e}")
+
+    async def flush_all(self):
+        """Сбрасывает все буферы (при остановке бота)"""
+        pending = list(self._pending.keys() | self._writing.keys())
+        for user_id in pending:
+            await self.flush(user_id)
+        stats = self.stats()
+        logger.info(
+            f"Буферы записей сброшены ({len(pending)} пользователей): записей {stats['entries']}, "
+            f"вставок {stats['batches']}, сэкономлено запросов {stats['writes_saved']}"
+        )
+
+    def stats(self):
+        """Счетчики записей, вставок и сэкономленных запросов"""
+        return {
+            'entries': self.entries,
+            'batches': self.batches,
+            'writes_saved': self.entries - self.batches,
+            'pending': sum(len(batch.counts) for batch in self._pending.values()),
+            'failed': self.failed,
+        }